@@ -0,0 +1,367 @@
+import logging
+import mmap
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# 缓存项键：(文件路径, 文件大小, 修改时间, 块序号)
+BlockKey = Tuple[str, int, float, int]
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class BlockCache:
+    """WebDAV 文件的本地块缓存
+
+    文件按固定大小切分为块，每块用一次 HTTP Range 请求获取，多个缺失的块并行下载。
+    所有块存放在一个预分配的内存映射文件中，按 LRU 顺序复用槽位。
+    顺序读取时提前下载后面的若干块，播放和跳转到最近读过的位置都不再经过公网。
+    键包含文件大小和修改时间，正在录制的片段变化后自动失效。
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, fetch: Callable[[str, int, int], bytes],
+                 block_size: int = 1024 * 1024, readahead: int = 8, workers: int = 8):
+        """
+        Args:
+            cache_dir: 块文件所在目录
+            max_bytes: 块文件大小上限，0 表示禁用
+            fetch: fetch(path, start, length) 从 WebDAV 读取一段字节
+            block_size: 块大小（字节）
+            readahead: 顺序读取时提前下载的块数
+            workers: 并行下载的线程数
+        """
+        self.block_size = block_size
+        self.readahead = readahead
+        self.slot_count = max_bytes // block_size if block_size > 0 else 0
+        self._fetch = fetch
+        # 块键 -> (槽位, 数据长度)，按最近访问排序
+        self._entries: 'OrderedDict[BlockKey, Tuple[int, int]]' = OrderedDict()
+        self._free_slots = list(range(self.slot_count - 1, -1, -1))
+        self._inflight: Dict[BlockKey, Future] = {}
+        self._lock = threading.Lock()
+        self._mmap: Optional[mmap.mmap] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.hits = 0
+        self.misses = 0
+        self.fetched_bytes = 0
+        self.evictions = 0
+        if self.enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._mmap = self._create_mmap(cache_dir, self.slot_count * block_size)
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='block-fetch')
+
+    @property
+    def enabled(self) -> bool:
+        return self.slot_count > 0
+
+    @staticmethod
+    def _create_mmap(cache_dir: str, size: int) -> mmap.mmap:
+        # 每个进程一个块文件，映射后立即删除，进程退出时由系统回收
+        fd, path = tempfile.mkstemp(prefix='blocks_', suffix='.bin', dir=cache_dir)
+        try:
+            os.ftruncate(fd, size)
+            mapped = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+            os.remove(path)
+        logger.info(f"Block cache mapped: {size} bytes")
+        return mapped
+
+    def read(self, path: str, size: int, mtime: float, start: int, length: int) -> bytes:
+        """读取文件中的一段字节，不在缓存中的块从 WebDAV 下载"""
+        return b''.join(self.iter_range(path, size, mtime, start, start + length - 1))
+
+    def iter_range(self, path: str, size: int, mtime: float, start: int, end: int) -> Iterator[bytes]:
+        """按块产出文件 [start, end] 范围内的字节，并提前下载后面的块
+
+        Args:
+            path: 文件路径
+            size: 文件大小
+            mtime: 文件修改时间
+            start: 起始偏移
+            end: 结束偏移（包含）
+        """
+        end = min(end, size - 1)
+        if start > end:
+            return
+        first_block = start // self.block_size
+        last_block = end // self.block_size
+        for block in range(first_block, last_block + 1):
+            # 只在请求范围内预读，短范围读取（例如文件末尾的 moov）不会多下载
+            self._schedule(path, size, mtime, range(block + 1, min(block + self.readahead, last_block) + 1))
+            data = self._get_block(path, size, mtime, block)
+            block_start = block * self.block_size
+            lo = max(start - block_start, 0)
+            hi = min(end - block_start + 1, len(data))
+            yield data[lo:hi] if lo or hi < len(data) else data
+
+    def prefetch(self, path: str, size: int, mtime: float, start: int, length: int) -> None:
+        """在后台下载一段字节到缓存，不等待完成"""
+        if not self.enabled or size <= 0:
+            return
+        end = min(start + length, size) - 1
+        self._schedule(path, size, mtime, range(start // self.block_size, end // self.block_size + 1))
+
+    def _get_block(self, path: str, size: int, mtime: float, block: int) -> bytes:
+        key = (path, size, mtime, block)
+        if not self.enabled:
+            return self._download(key)
+        with self._lock:
+            data = self._lookup(key)
+            if data is not None:
+                self.hits += 1
+                return data
+            self.misses += 1
+            future = self._inflight.get(key)
+            if future is None:
+                # 当前需要的块直接在调用线程下载，不排在预读任务之后
+                future = Future()
+                self._inflight[key] = future
+                owner = True
+            else:
+                owner = False
+        if owner:
+            self._fetch_block(key, future)
+        return future.result()
+
+    def _schedule(self, path: str, size: int, mtime: float, blocks) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            for block in blocks:
+                key = (path, size, mtime, block)
+                if key not in self._entries and key not in self._inflight:
+                    self._submit(key)
+
+    def _submit(self, key: BlockKey) -> None:
+        # 调用方持有 _lock
+        future = Future()
+        self._inflight[key] = future
+        self._executor.submit(self._fetch_block, key, future)
+
+    def _lookup(self, key: BlockKey) -> Optional[bytes]:
+        # 调用方持有 _lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        slot, length = entry
+        offset = slot * self.block_size
+        return self._mmap[offset:offset + length]
+
+    def _download(self, key: BlockKey) -> bytes:
+        path, size, _, block = key
+        start = block * self.block_size
+        length = min(self.block_size, size - start)
+        data = self._fetch(path, start, length)
+        if len(data) != length:
+            raise IOError(f"Short read for {path} block {block}: {len(data)}/{length} bytes")
+        return data
+
+    def _fetch_block(self, key: BlockKey, future: Future) -> None:
+        try:
+            data = self._download(key)
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            logger.warning(f"Block fetch failed for {key[0]} block {key[3]}: {e}")
+            future.set_exception(e)
+            return
+        with self._lock:
+            self._inflight.pop(key, None)
+            self.fetched_bytes += len(data)
+            slot = self._allocate_slot()
+            offset = slot * self.block_size
+            self._mmap[offset:offset + len(data)] = data
+            self._entries[key] = (slot, len(data))
+        future.set_result(data)
+
+    def _allocate_slot(self) -> int:
+        # 调用方持有 _lock；没有空闲槽位时淘汰最久未访问的块
+        if self._free_slots:
+            return self._free_slots.pop()
+        _, (slot, _) = self._entries.popitem(last=False)
+        self.evictions += 1
+        return slot
+
+    def stats(self) -> Dict:
+        """块缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'block_size': self.block_size,
+                'blocks': len(self._entries),
+                'capacity_blocks': self.slot_count,
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'fetched_bytes': self.fetched_bytes,
+                'evictions': self.evictions,
+            }
+
+
+class BlockCacheServer:
+    """在 127.0.0.1 上提供 HTTP Range 读取的本地代理，作为 FFmpeg 的输入
+
+    FFmpeg 通过本地地址读取文件，所有字节都经过 BlockCache，
+    跳转产生的 Range 请求命中缓存时不会访问 NAS。
+    """
+
+    def __init__(self, cache: BlockCache, stat: Callable[[str], Optional[Tuple[int, float]]],
+                 stat_ttl: float = 10.0, stat_cache_size: int = 1024):
+        """
+        Args:
+            cache: 块缓存
+            stat: stat(path) 返回 (size, mtime)，文件不存在时返回 None
+            stat_ttl: 文件大小和修改时间的缓存时间（秒）
+            stat_cache_size: 最多缓存的文件数，超出时淘汰最久未访问的
+        """
+        self.cache = cache
+        self._stat = stat
+        self._stat_ttl = stat_ttl
+        self._stat_cache_size = stat_cache_size
+        # 文件路径 -> (查询时间, (size, mtime))，按最近访问排序
+        self._stats: 'OrderedDict[str, Tuple[float, Optional[Tuple[int, float]]]]' = OrderedDict()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._lock = threading.Lock()
+
+    def url_for(self, path: str, size: int = 0, mtime: float = 0.0) -> str:
+        """返回文件在本地代理上的地址，第一次调用时启动代理
+
+        已知文件大小和修改时间时放在查询参数中，代理无需再查询 WebDAV。
+        """
+        port = self._ensure_started()
+        url = f"http://127.0.0.1:{port}{quote(path)}"
+        if size > 0:
+            url += f"?size={size}&mtime={mtime!r}"
+        return url
+
+    def _ensure_started(self) -> int:
+        with self._lock:
+            if self._server is None:
+                server = _ProxyHTTPServer(('127.0.0.1', 0), _make_handler(self))
+                server.daemon_threads = True
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                self._server = server
+                logger.info(f"Block cache proxy listening on 127.0.0.1:{server.server_address[1]}")
+            return self._server.server_address[1]
+
+    def resolve(self, path: str, query: str) -> Optional[Tuple[int, float]]:
+        """确定文件大小和修改时间，优先使用 URL 中携带的值"""
+        params = parse_qs(query)
+        if 'size' in params:
+            try:
+                return int(params['size'][0]), float(params.get('mtime', ['0'])[0])
+            except ValueError:
+                pass
+        now = time.time()
+        with self._lock:
+            cached = self._stats.get(path)
+            if cached and now - cached[0] < self._stat_ttl:
+                self._stats.move_to_end(path)
+                return cached[1]
+        result = self._stat(path)
+        with self._lock:
+            self._stats[path] = (now, result)
+            self._stats.move_to_end(path)
+            while len(self._stats) > self._stat_cache_size:
+                self._stats.popitem(last=False)
+        return result
+
+    def shutdown(self) -> None:
+        with self._lock:
+            server, self._server = self._server, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+class _ProxyHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # FFmpeg 跳转或退出时会重置保持中的连接，不记录为错误
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def _make_handler(proxy: BlockCacheServer):
+    class BlockCacheHandler(BaseHTTPRequestHandler):
+        # HTTP/1.1 保持连接，FFmpeg 的 -multiple_requests 可以复用
+        protocol_version = 'HTTP/1.1'
+
+        def do_HEAD(self):
+            self._serve(send_body=False)
+
+        def do_GET(self):
+            self._serve(send_body=True)
+
+        def _serve(self, send_body: bool) -> None:
+            parts = urlsplit(self.path)
+            path = unquote(parts.path)
+            try:
+                info = proxy.resolve(path, parts.query)
+            except Exception as e:
+                logger.error(f"Block cache proxy stat failed for {path}: {e}")
+                self.send_error(502)
+                return
+            if info is None or info[0] <= 0:
+                self.send_error(404)
+                return
+            size, mtime = info
+
+            start, end = 0, size - 1
+            status = 200
+            range_header = self.headers.get('Range')
+            if range_header:
+                match = RANGE_PATTERN.match(range_header.strip())
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        if match.group(2):
+                            end = min(int(match.group(2)), size - 1)
+                    else:
+                        # bytes=-N 表示最后 N 个字节
+                        start = max(size - int(match.group(2)), 0)
+                    if start >= size or start > end:
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{size}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    status = 206
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+            if not send_body:
+                return
+            try:
+                for data in proxy.cache.iter_range(path, size, mtime, start, end):
+                    self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # FFmpeg 跳转时会直接关闭连接
+                self.close_connection = True
+            except Exception as e:
+                logger.error(f"Block cache proxy read failed for {path}: {e}")
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return BlockCacheHandler
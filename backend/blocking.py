@@ -0,0 +1,24 @@
+import sys
+from typing import Callable, TypeVar
+
+T = TypeVar('T')
+
+
+def _gevent_patched() -> bool:
+    # 只在 gevent worker 已经 monkey patch 时使用 gevent，其他 worker 不需要安装 gevent
+    if 'gevent' not in sys.modules:
+        return False
+    from gevent import monkey
+    return monkey.is_module_patched('threading')
+
+
+def call_blocking(fn: Callable[..., T], *args) -> T:
+    """执行会阻塞整个进程的调用（例如 SQLite 等待其他进程的写锁）
+
+    gevent 只能让出打过补丁的 Python 调用，SQLite 的 C 调用等锁时整个 worker 的所有协程都会停住。
+    gevent worker 中把调用放到 gevent 的原生线程池执行，等待期间其他协程照常运行；其他 worker 直接调用。
+    """
+    if _gevent_patched():
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)
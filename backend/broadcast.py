@@ -0,0 +1,343 @@
+import itertools
+import logging
+import subprocess
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Set, Tuple
+
+from .fmp4 import Fmp4Splitter, fragment_starts_with_keyframe
+from .metrics import FFMPEG_EXITS, FFMPEG_FIRST_OUTPUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# 每次从 FFmpeg stdout 读取的最大字节数，读入同一个复用的缓冲区
+STDOUT_READ_SIZE = 256 * 1024
+
+
+class Broadcast:
+    """一个 FFmpeg 进程的输出分发给多个观看者
+
+    读取线程把 FFmpeg 输出切分为初始化段和 moof+mdat 分片，保存在有界环形缓冲区中。
+    FFmpeg 的节奏由读得最快的观看者决定：它领先最新分片不到缓冲区容量时读取线程才等待，
+    暂停或链路慢的观看者不会拖住其他人。落后到缓冲区之外的观看者跳到缓冲区中最新的关键帧分片继续播放。
+    后加入的观看者先收到初始化段，再从最新的关键帧分片开始播放；缓冲区中没有关键帧时跳过分片直到下一个关键帧。
+    """
+
+    def __init__(self, key: Hashable, cmd: List[str], ring_size: int = 30,
+                 on_finished: Optional[Callable[['Broadcast'], None]] = None):
+        self.key = key
+        self.cmd = cmd
+        self.ring_size = ring_size
+        self.process: Optional[subprocess.Popen] = None
+        self.init_segment: Optional[bytes] = None
+        self.return_code: Optional[int] = None
+        self.finished = False
+        self.closed = False
+        self.total_bytes = 0
+        self.started_at = time.time()
+        self.first_chunk_at: Optional[float] = None
+        self._on_finished = on_finished
+        # (seq, data, is_keyframe)
+        self._fragments: deque = deque()
+        self._next_seq = 0
+        # 观看者 ID -> 下一个要读取的分片序号
+        self._cursors: Dict[int, int] = {}
+        # 需要从关键帧重新开始的观看者，读取时跳过非关键帧分片
+        self._resync: Set[int] = set()
+        # 落后到缓冲区之外被跳到最新关键帧的次数
+        self.skips = 0
+        self._sub_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._stderr_tail: deque = deque(maxlen=50)
+        # 输出监听器（例如写入磁盘缓存），依次收到 'init'/'fragment' 数据，
+        # 结束时收到 'complete'（FFmpeg 正常退出）或 'abort'
+        self.listeners: List[Callable[[str, bytes], None]] = []
+        # stderr 行处理器（例如解析 -progress 输出），返回 True 表示该行已处理，不计入错误日志
+        self.stderr_handler: Optional[Callable[[str], bool]] = None
+
+    @property
+    def subscriber_count(self) -> int:
+        with self._cond:
+            return len(self._cursors)
+
+    @property
+    def stderr_output(self) -> str:
+        return '\n'.join(self._stderr_tail)
+
+    def start(self) -> None:
+        """启动 FFmpeg 进程和读取线程"""
+        self.started_at = time.time()
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0
+        )
+        threading.Thread(target=self._read_stdout, daemon=True).start()
+        threading.Thread(target=self._read_stderr, daemon=True).start()
+
+    def subscribe(self) -> Optional[int]:
+        """注册一个观看者，返回观看者 ID；广播已关闭或已结束时返回 None"""
+        with self._cond:
+            if self.closed or self.finished:
+                return None
+            sub_id = next(self._sub_ids)
+            self._cursors[sub_id] = self._join_position(sub_id)
+            self._cond.notify_all()
+            return sub_id
+
+    def _join_position(self, sub_id: int) -> int:
+        # 还没有输出过分片时从头开始，否则从缓冲区中最新的关键帧分片开始；
+        # 缓冲区中没有关键帧时从下一个分片开始，跳过非关键帧分片
+        if not self._fragments and self._next_seq == 0:
+            return 0
+        for seq, _, is_key in reversed(self._fragments):
+            if is_key:
+                return seq
+        self._resync.add(sub_id)
+        return self._next_seq
+
+    def unsubscribe(self, sub_id: int) -> None:
+        """注销观看者，最后一个观看者离开时终止 FFmpeg
+
+        是否最后一个观看者和标记关闭在同一把锁内完成，之后的 subscribe 会看到已关闭而不会加入
+        """
+        with self._cond:
+            self._cursors.pop(sub_id, None)
+            self._resync.discard(sub_id)
+            last = not self._cursors and not self.closed
+            if last:
+                self.closed = True
+            self._cond.notify_all()
+        if last:
+            threading.Thread(target=self._terminate, daemon=True).start()
+
+    def close(self, wait: bool = True) -> None:
+        """停止广播并终止 FFmpeg 进程
+
+        Args:
+            wait: False 时在后台线程中等待进程退出，不阻塞调用方
+        """
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+        if not wait:
+            threading.Thread(target=self._terminate, daemon=True).start()
+        else:
+            self._terminate()
+
+    def _terminate(self) -> None:
+        process = self.process
+        if process and process.poll() is None:
+            logger.info(f"Terminating broadcast process for {self.key}")
+            process.terminate()
+            try:
+                process.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Broadcast process for {self.key} didn't terminate gracefully, killing...")
+                process.kill()
+                process.wait()
+
+    def iter_subscriber(self, sub_id: int, should_stop: Callable[[], bool],
+                        first_chunk_timeout: float = 10) -> Iterator[bytes]:
+        """按顺序产出某个观看者的数据：先初始化段，再各个分片
+
+        Args:
+            sub_id: subscribe 返回的观看者 ID
+            should_stop: 返回 True 时停止产出
+            first_chunk_timeout: 等待初始化段的超时时间（秒）
+        """
+        started = time.time()
+        sent_init = False
+        while True:
+            with self._cond:
+                while True:
+                    if should_stop() or self.closed or sub_id not in self._cursors:
+                        return
+                    if not sent_init:
+                        if self.init_segment is not None:
+                            break
+                        if self.finished:
+                            return
+                        if time.time() - started > first_chunk_timeout:
+                            logger.error(f"FFmpeg timeout: no data received within {first_chunk_timeout} seconds")
+                            return
+                    else:
+                        cursor = self._cursors[sub_id]
+                        if cursor < self._next_seq:
+                            break
+                        if self.finished:
+                            return
+                    self._cond.wait(timeout=1.0)
+
+                if not sent_init:
+                    data = self.init_segment
+                    sent_init = True
+                else:
+                    cursor = self._cursors[sub_id]
+                    first_seq = self._fragments[0][0]
+                    _, data, is_key = self._fragments[cursor - first_seq]
+                    self._cursors[sub_id] = cursor + 1
+                    self._cond.notify_all()
+                    if sub_id in self._resync:
+                        if not is_key:
+                            continue
+                        self._resync.discard(sub_id)
+            yield data
+
+    def _trim(self) -> None:
+        # 丢弃超出缓冲区容量的分片，落后到缓冲区之外的观看者跳到最新的关键帧分片
+        while len(self._fragments) > self.ring_size:
+            self._fragments.popleft()
+        first_seq = self._fragments[0][0] if self._fragments else self._next_seq
+        for sub_id, cursor in self._cursors.items():
+            if cursor < first_seq:
+                self._cursors[sub_id] = self._join_position(sub_id)
+                self.skips += 1
+                logger.info(f"Viewer {sub_id} of broadcast {self.key} fell behind, skipped to seq "
+                            f"{self._cursors[sub_id]}")
+
+    def _notify_listeners(self, kind: str, data: bytes = b'') -> None:
+        for listener in self.listeners:
+            try:
+                listener(kind, data)
+            except Exception as e:
+                logger.error(f"Broadcast listener error: {e}")
+
+    def _publish(self, kind: str, data: bytes, splitter: Fmp4Splitter) -> None:
+        self._notify_listeners(kind, data)
+
+        with self._cond:
+            if kind == 'init':
+                self.init_segment = data
+                self._cond.notify_all()
+                return
+            # 读得最快的观看者也落后最新分片一整个缓冲区时等待，慢的观看者由 _trim 跳过
+            while not self.closed and self._cursors \
+                    and self._next_seq - max(self._cursors.values()) >= self.ring_size:
+                self._cond.wait(timeout=1.0)
+            if self.closed:
+                return
+            is_key = fragment_starts_with_keyframe(data, splitter.init_info)
+            self._fragments.append((self._next_seq, data, is_key))
+            self._next_seq += 1
+            self._trim()
+            self._cond.notify_all()
+
+    def _read_stdout(self) -> None:
+        splitter = Fmp4Splitter()
+        buffer = bytearray(STDOUT_READ_SIZE)
+        view = memoryview(buffer)
+        try:
+            while not self.closed:
+                # readinto 复用同一块缓冲区，不为每次读取分配新的 bytes；切分器把它追加到自己的缓冲区，
+                # 每个初始化段和分片只在完整后复制一次，之后缓冲区和监听器共用同一个 bytes 对象
+                size = self.process.stdout.readinto(buffer)
+                if not size:
+                    break
+                if self.first_chunk_at is None:
+                    self.first_chunk_at = time.time()
+                    FFMPEG_FIRST_OUTPUT_SECONDS.observe(self.first_chunk_at - self.started_at)
+                    logger.info(f"First chunk received: {size} bytes")
+                self.total_bytes += size
+                for kind, data in splitter.feed(view[:size]):
+                    self._publish(kind, data, splitter)
+            for kind, data in splitter.flush():
+                self._publish(kind, data, splitter)
+        except Exception as e:
+            logger.error(f"Error reading FFmpeg output: {str(e)}")
+        finally:
+            try:
+                self.return_code = self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.return_code = self.process.wait()
+            if self.return_code != 0 and not self.closed:
+                logger.error(f"FFmpeg process failed with return code {self.return_code}")
+                logger.error(f"FFmpeg stderr: {self.stderr_output}")
+            else:
+                logger.info(f"FFmpeg broadcast {self.key} finished, {self.total_bytes} bytes")
+            # 被提前终止（观看者全部离开）的进程退出码不代表错误，单独标记
+            FFMPEG_EXITS.inc(code=self.return_code, terminated='true' if self.closed else 'false')
+            # 被提前关闭的广播输出不完整
+            self._notify_listeners('complete' if self.return_code == 0 and not self.closed else 'abort')
+            with self._cond:
+                self.finished = True
+                self._cond.notify_all()
+            if self._on_finished:
+                self._on_finished(self)
+
+    def _read_stderr(self) -> None:
+        # 持续读取 stderr，避免管道写满导致 FFmpeg 阻塞
+        try:
+            for line in iter(self.process.stderr.readline, b''):
+                text = line.decode('utf-8', 'replace').rstrip()
+                if self.stderr_handler and self.stderr_handler(text):
+                    continue
+                self._stderr_tail.append(text)
+        except Exception:
+            pass
+
+
+class BroadcastManager:
+    """按 (video_path, offset, profile) 复用正在运行的 Broadcast"""
+
+    def __init__(self, ring_size: int = 30):
+        self.ring_size = ring_size
+        self._broadcasts: Dict[Hashable, Broadcast] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key: Hashable, cmd_factory: Callable[[], List[str]],
+                  on_create: Optional[Callable[[Broadcast], None]] = None) -> Tuple[Broadcast, int, bool]:
+        """加入已有的广播，或者启动新的广播
+
+        Args:
+            key: 广播键
+            cmd_factory: 返回 FFmpeg 命令的可调用对象，只在需要启动新进程时调用
+            on_create: 新广播启动前的回调，可用于注册监听器；抛出异常时不启动 FFmpeg，异常传给调用方
+
+        Returns:
+            (broadcast, sub_id, created) 元组
+        """
+        with self._lock:
+            broadcast = self._broadcasts.get(key)
+            if broadcast is not None:
+                # 广播可能刚刚因为最后一个观看者离开而关闭，这时启动新的广播
+                sub_id = broadcast.subscribe()
+                if sub_id is not None:
+                    logger.info(f"Joined existing broadcast {key} ({broadcast.subscriber_count} viewers)")
+                    return broadcast, sub_id, False
+
+            broadcast = Broadcast(key, cmd_factory(), self.ring_size, on_finished=self._remove)
+            # 先注册观看者再启动进程，保证第一个观看者从头开始
+            sub_id = broadcast.subscribe()
+            self._broadcasts[key] = broadcast
+        try:
+            if on_create:
+                on_create(broadcast)
+            broadcast.start()
+        except Exception:
+            self._remove(broadcast)
+            # 期间加入的观看者随广播关闭而结束；让监听器清理临时文件、归还名额
+            broadcast.close()
+            broadcast._notify_listeners('abort')
+            raise
+        return broadcast, sub_id, True
+
+    def is_running(self, key: Hashable) -> bool:
+        """是否有可加入的同键广播"""
+        with self._lock:
+            broadcast = self._broadcasts.get(key)
+            return broadcast is not None and not broadcast.finished and not broadcast.closed
+
+    def _remove(self, broadcast: Broadcast) -> None:
+        with self._lock:
+            if self._broadcasts.get(broadcast.key) is broadcast:
+                del self._broadcasts[broadcast.key]
+
+    def list(self) -> List[Broadcast]:
+        with self._lock:
+            return list(self._broadcasts.values())
@@ -0,0 +1,251 @@
+import logging
+import multiprocessing
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .scheduler import PRIORITY_BACKGROUND, TranscodeScheduler
+from .segment_catalog import SegmentCatalog
+
+logger = logging.getLogger(__name__)
+
+# 认领的分析任务超过该时间没有完成（worker 崩溃）时允许重新认领
+SCAN_STALE_SECONDS = 900
+# 分析失败的片段在该时间之后才重试
+SCAN_RETRY_SECONDS = 3600
+# 亮度差超过该值的像素才算变化，过滤传感器噪声和压缩噪声
+PIXEL_DELTA = 20
+
+_PTS_RE = re.compile(r'pts_time:([0-9.]+)')
+
+
+def score_segment(url: str, width: int = 160, timeout: float = 300) -> List[Tuple[float, float]]:
+    """计算片段内每个关键帧相对上一个关键帧的画面变化分数（在进程池中运行）
+
+    只解码关键帧并缩小到 width 宽的灰度图，逐像素求与上一个关键帧的差，
+    分数为变化像素占画面的比例（0~1）：静止画面为 0，有人走过时为人所占的面积比例。
+
+    Returns:
+        [(片段内偏移秒数, 分数)]
+    """
+    cmd = [
+        'ffmpeg', '-v', 'error',
+        '-skip_frame', 'nokey',
+        '-i', url,
+        '-an',
+        '-vf', (f"scale={width}:-2,format=gray,tblend=all_mode=difference,"
+                f"lutyuv=y='if(gt(val,{PIXEL_DELTA}),255,0)',signalstats,"
+                f"metadata=print:key=lavfi.signalstats.YAVG:file=-"),
+        '-f', 'null', '-'
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip()[-500:])
+    scores = []
+    offset = None
+    for line in result.stdout.decode('utf-8', 'replace').splitlines():
+        match = _PTS_RE.search(line)
+        if match:
+            offset = float(match.group(1))
+        elif line.startswith('lavfi.signalstats.YAVG=') and offset is not None:
+            scores.append((offset, float(line.split('=', 1)[1]) / 255))
+            offset = None
+    return scores
+
+
+def merge_events(segment_start: datetime, scores: List[Tuple[float, float]], threshold: float,
+                 merge_gap: float) -> List[Tuple[datetime, datetime, float]]:
+    """把超过阈值的关键帧合并为事件：相邻超阈值关键帧间隔不超过 merge_gap 秒时属于同一事件
+
+    事件从变化出现前的上一个关键帧开始，到最后一个超阈值关键帧结束，分数取峰值。
+
+    Returns:
+        [(start_time, end_time, peak_score)]
+    """
+    events = []
+    previous_offset = 0.0
+    current = None
+    for offset, score in scores:
+        if score >= threshold:
+            if current is not None and offset - current[1] <= merge_gap:
+                current[1] = offset
+                current[2] = max(current[2], score)
+            else:
+                if current is not None:
+                    events.append(current)
+                current = [previous_offset, offset, score]
+        previous_offset = offset
+    if current is not None:
+        events.append(current)
+    return [(segment_start + timedelta(seconds=start), segment_start + timedelta(seconds=end), score)
+            for start, end, score in events]
+
+
+class EventIndex:
+    """后台画面变化分析，按摄像头建立事件索引
+
+    每个片段只解码关键帧、缩小后计算相邻关键帧之间变化像素的比例，超过阈值的合并为事件，
+    与片段元数据一起保存在片段目录（SQLite）中。分析在有界进程池中执行并以后台优先级申请转码名额，
+    多个 worker 通过片段目录认领任务，同一片段只分析一次；片段大小或修改时间变化后重新分析。
+    """
+
+    def __init__(self, catalog: SegmentCatalog, url_for: Callable[[Dict], str], threshold: float = 0.01,
+                 merge_gap: float = 10, width: int = 160, workers: int = 1,
+                 scheduler: Optional[TranscodeScheduler] = None):
+        """
+        Args:
+            catalog: 保存事件和分析状态的片段目录
+            url_for: url_for(segment) 返回片段的读取地址
+            threshold: 变化像素比例的阈值
+            merge_gap: 合并为同一事件的最大间隔（秒）
+            width: 分析时缩小到的宽度
+            workers: 进程池大小
+            scheduler: FFmpeg 准入控制，分析以后台优先级申请名额，给交互播放让路
+        """
+        self.catalog = catalog
+        self.threshold = threshold
+        self.merge_gap = merge_gap
+        self.width = width
+        self._url_for = url_for
+        self._workers = workers
+        self._transcode_scheduler = scheduler
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._builder = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='events')
+        self._jobs: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+        self.scanned = 0
+        self.failed = 0
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # spawn 避免在多线程的 Web 进程中 fork
+                self._pool = ProcessPoolExecutor(max_workers=self._workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def scan(self, video_dir: str, segments: List[Dict]) -> Dict:
+        """把尚未分析的片段加入后台分析队列
+
+        Args:
+            video_dir: 摄像头目录
+            segments: 片段列表，每项包含 filename/path/start_time/end_time/size/mtime
+
+        Returns:
+            {'scanned': 已分析的片段数, 'pending': 排队或分析中的片段数}
+        """
+        states = self.catalog.event_scan_states(video_dir, [segment['filename'] for segment in segments])
+        now = time.time()
+        scanned = pending = 0
+        for segment in segments:
+            state = states.get(segment['filename'])
+            if state is not None:
+                status, size, mtime, updated_at = state
+                if size == segment['size'] and mtime == segment['mtime']:
+                    if status == 'done':
+                        scanned += 1
+                        continue
+                    if status == 'failed' and now - updated_at < SCAN_RETRY_SECONDS:
+                        continue
+            pending += 1
+            key = (video_dir, segment['filename'])
+            with self._lock:
+                if key in self._jobs:
+                    continue
+                self._jobs[key] = self._builder.submit(self._scan_segment, video_dir, segment)
+                job = self._jobs[key]
+            job.add_done_callback(lambda done, key=key: self._finish(key, done))
+        return {'scanned': scanned, 'pending': pending}
+
+    def _finish(self, key: Tuple[str, str], job: Future) -> None:
+        with self._lock:
+            self._jobs.pop(key, None)
+        if job.exception() is not None:
+            logger.error(f"Event scan failed for {key[1]}: {job.exception()}")
+
+    def _scan_segment(self, video_dir: str, segment: Dict) -> None:
+        filename = segment['filename']
+        if not self.catalog.claim_event_scan(video_dir, filename, segment['size'], segment['mtime'],
+                                             SCAN_STALE_SECONDS):
+            # 已经分析过，或者其他 worker 正在分析
+            return
+        ticket = None
+        if self._transcode_scheduler is not None:
+            ticket = self._transcode_scheduler.request(video_dir, 'events', PRIORITY_BACKGROUND)
+            self._transcode_scheduler.wait(ticket)
+        try:
+            started = time.perf_counter()
+            scores = self._get_pool().submit(score_segment, self._url_for(segment), self.width).result()
+            events = merge_events(segment['start_time'], scores, self.threshold, self.merge_gap)
+            self.catalog.save_events(video_dir, filename, segment['size'], segment['mtime'], events)
+            self.scanned += 1
+            logger.info(f"Scanned {filename}: {len(scores)} keyframes, {len(events)} events "
+                        f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+        except Exception:
+            self.failed += 1
+            self.catalog.fail_event_scan(video_dir, filename)
+            raise
+        finally:
+            if ticket is not None:
+                self._transcode_scheduler.release(ticket)
+
+    def events(self, video_dir: str, start: datetime, end: datetime) -> List[Dict]:
+        """[start, end) 内的事件"""
+        return [self._describe(event) for event in self.catalog.events_between(video_dir, start, end)]
+
+    def adjacent(self, video_dir: str, target: datetime, forward: bool = True) -> Optional[Dict]:
+        """target 之后（或之前）最近的事件"""
+        event = self.catalog.adjacent_event(video_dir, target, forward)
+        return self._describe(event) if event else None
+
+    @staticmethod
+    def _describe(event: Tuple[datetime, datetime, float, str]) -> Dict:
+        start, end, score, filename = event
+        return {
+            'start_time': start.strftime('%Y-%m-%d %H:%M:%S'),
+            'end_time': end.strftime('%Y-%m-%d %H:%M:%S'),
+            'score': round(score, 4),
+            'filename': filename,
+        }
+
+    def start_sweeper(self, list_segments: Callable[[datetime, datetime], List[Tuple[str, List[Dict]]]],
+                      interval: float, lookback_hours: float) -> None:
+        """启动后台线程，每 interval 秒把最近 lookback_hours 小时内的新片段加入分析队列
+
+        Args:
+            list_segments: list_segments(start, end) 返回 [(video_dir, segments)]
+            interval: 扫描间隔（秒），0 表示不启动
+            lookback_hours: 每次扫描覆盖的时长（小时）
+        """
+        if interval <= 0:
+            return
+
+        def run():
+            while True:
+                try:
+                    end = datetime.now()
+                    for video_dir, segments in list_segments(end - timedelta(hours=lookback_hours), end):
+                        # 正在录制的最后一个片段还会变化，等它结束后再分析
+                        done = [segment for segment in segments if segment['end_time'] <= end]
+                        result = self.scan(video_dir, done)
+                        if result['pending']:
+                            logger.info(f"Queued {result['pending']} segments of {video_dir} for event scan")
+                except Exception as e:
+                    logger.error(f"Event sweep failed: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=run, name='event-sweeper', daemon=True).start()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            queued = len(self._jobs)
+        return {
+            'threshold': self.threshold,
+            'queued': queued,
+            'scanned': self.scanned,
+            'failed': self.failed,
+        }
@@ -0,0 +1,77 @@
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .media_probe import BROWSER_AUDIO_CODECS
+
+logger = logging.getLogger(__name__)
+
+# 一次导出最多覆盖的时长（小时）
+MAX_EXPORT_HOURS = 6
+
+
+def plan_clip(segments: List[Dict], start: datetime, end: datetime) -> Optional[Dict]:
+    """把 [start, end) 映射到覆盖它的片段上
+
+    Args:
+        segments: 按时间排序、与 [start, end) 有重叠的片段，每项包含 path/start_time/end_time/size/mtime
+        start: 导出开始时间
+        end: 导出结束时间
+
+    Returns:
+        {'segments': 片段列表, 'inpoint': 第一个片段内的起始偏移, 'outpoint': 最后一个片段内的结束偏移（到结尾时为 None）}，
+        没有片段时返回 None。片段之间缺失的录像直接跳过
+    """
+    segments = [segment for segment in segments if segment['start_time'] < end and segment['end_time'] > start]
+    if not segments:
+        return None
+    first, last = segments[0], segments[-1]
+    inpoint = max(0.0, (start - first['start_time']).total_seconds())
+    outpoint = None
+    if end < last['end_time']:
+        outpoint = (end - last['start_time']).total_seconds()
+    return {'segments': segments, 'inpoint': inpoint, 'outpoint': outpoint}
+
+
+def export_audio_codec(info: Optional[Dict]) -> str:
+    """MP4 可以直接容纳的音频复制，其他编码（例如 PCM）转为 AAC；编码未知时按需转码"""
+    if info is not None and info['audio_codec'] in BROWSER_AUDIO_CODECS:
+        return 'copy'
+    return 'aac'
+
+
+def build_export_command(playlist_path: str, audio_codec: str = 'copy') -> List[str]:
+    """构建导出片段的 FFmpeg 命令：concat demuxer 拼接播放列表中的片段，视频只复制不转码
+
+    复制模式下第一个片段从 inpoint 之前最近的关键帧开始，最后一个片段在 outpoint 处结束，
+    输出分片 MP4，边生成边推送，不需要先写完整个文件再回头改写 moov。
+
+    Args:
+        playlist_path: write_ffconcat 生成的播放列表，第一个片段带 inpoint，最后一个片段带 outpoint
+        audio_codec: 'copy' 复制音频，'aac' 转码为 AAC
+
+    Returns:
+        FFmpeg 命令参数列表
+    """
+    cmd = [
+        'ffmpeg',
+        '-nostats',
+        '-f', 'concat',
+        '-safe', '0',
+        '-protocol_whitelist', 'file,http,https,tcp,tls,crypto',
+        '-i', playlist_path,
+        '-map', '0:v:0',
+        '-map', '0:a:0?',  # 没有音轨的录像只导出视频
+        '-c:v', 'copy',
+    ]
+    if audio_codec == 'copy':
+        cmd.extend(['-c:a', 'copy'])
+    else:
+        cmd.extend(['-c:a', 'aac', '-b:a', '128k'])
+    cmd.extend([
+        '-f', 'mp4',
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+        '-y',
+        'pipe:1'
+    ])
+    return cmd
@@ -0,0 +1,185 @@
+import struct
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# trun/tfhd/trex 中 sample_flags 的 sample_is_non_sync_sample 位
+NON_SYNC_SAMPLE = 0x00010000
+
+# 分片开头可能出现在 moof 之前的 box
+FRAGMENT_PREFIX_BOXES = {b'styp', b'sidx', b'prft'}
+
+
+def iter_boxes(data, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[bytes, int, int]]:
+    """遍历 [start, end) 范围内的 box
+
+    Returns:
+        (box_type, payload_start, box_end) 生成器
+    """
+    if end is None:
+        end = len(data)
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _find_box(data, start: int, end: int, box_type: bytes) -> Optional[Tuple[int, int]]:
+    for child_type, payload_start, box_end in iter_boxes(data, start, end):
+        if child_type == box_type:
+            return payload_start, box_end
+    return None
+
+
+def parse_init_segment(data: bytes) -> Dict:
+    """从 ftyp+moov 初始化段中解析视频轨道 ID 和 trex 默认 sample_flags
+
+    Returns:
+        {'video_track_id': int 或 None, 'default_flags': {track_id: flags}}
+    """
+    info = {'video_track_id': None, 'default_flags': {}}
+    moov = _find_box(data, 0, len(data), b'moov')
+    if moov is None:
+        return info
+    for box_type, payload_start, box_end in iter_boxes(data, *moov):
+        if box_type == b'trak':
+            track_id = None
+            tkhd = _find_box(data, payload_start, box_end, b'tkhd')
+            if tkhd is not None:
+                version = data[tkhd[0]]
+                # tkhd: version/flags(4) + 创建/修改时间(各 4 或 8 字节) + track_ID
+                offset = tkhd[0] + 4 + (16 if version == 1 else 8)
+                track_id = struct.unpack_from('>I', data, offset)[0]
+            mdia = _find_box(data, payload_start, box_end, b'mdia')
+            hdlr = _find_box(data, mdia[0], mdia[1], b'hdlr') if mdia else None
+            # hdlr: version/flags(4) + pre_defined(4) + handler_type(4)
+            if hdlr is not None and data[hdlr[0] + 8:hdlr[0] + 12] == b'vide' and info['video_track_id'] is None:
+                info['video_track_id'] = track_id
+        elif box_type == b'mvex':
+            for child_type, child_start, _ in iter_boxes(data, payload_start, box_end):
+                if child_type == b'trex':
+                    track_id, _, _, _, flags = struct.unpack_from('>IIIII', data, child_start + 4)
+                    info['default_flags'][track_id] = flags
+    return info
+
+
+def fragment_starts_with_keyframe(data: bytes, init_info: Optional[Dict] = None) -> bool:
+    """判断一个 moof 分片的视频轨第一帧是否为关键帧
+
+    无法判断（没有视频轨、缺少必要字段）时返回 True，交给播放器处理。
+    """
+    init_info = init_info or {'video_track_id': None, 'default_flags': {}}
+    video_track_id = init_info['video_track_id']
+    moof = _find_box(data, 0, len(data), b'moof')
+    if moof is None:
+        return True
+    for box_type, payload_start, box_end in iter_boxes(data, *moof):
+        if box_type != b'traf':
+            continue
+        tfhd = _find_box(data, payload_start, box_end, b'tfhd')
+        trun = _find_box(data, payload_start, box_end, b'trun')
+        if tfhd is None or trun is None:
+            continue
+        tfhd_flags = struct.unpack_from('>I', data, tfhd[0])[0] & 0xFFFFFF
+        track_id = struct.unpack_from('>I', data, tfhd[0] + 4)[0]
+        if video_track_id is not None and track_id != video_track_id:
+            continue
+
+        flags = init_info['default_flags'].get(track_id)
+        if tfhd_flags & 0x20:
+            offset = tfhd[0] + 8
+            for bit, size in ((0x1, 8), (0x2, 4), (0x8, 4), (0x10, 4)):
+                if tfhd_flags & bit:
+                    offset += size
+            flags = struct.unpack_from('>I', data, offset)[0]
+
+        trun_flags = struct.unpack_from('>I', data, trun[0])[0] & 0xFFFFFF
+        offset = trun[0] + 8
+        if trun_flags & 0x1:
+            offset += 4
+        if trun_flags & 0x4:
+            flags = struct.unpack_from('>I', data, offset)[0]
+        elif trun_flags & 0x400:
+            # 没有 first_sample_flags 时取第一个 sample 自带的 flags
+            for bit in (0x100, 0x200):
+                if trun_flags & bit:
+                    offset += 4
+            flags = struct.unpack_from('>I', data, offset)[0]
+
+        if flags is None:
+            return True
+        return not flags & NON_SYNC_SAMPLE
+    return True
+
+
+class Fmp4Splitter:
+    """把 FFmpeg 输出的分片 MP4 字节流切分为初始化段和 moof+mdat 分片
+
+    输入追加到同一个缓冲区，只解析 box 头部；每个初始化段和分片在完整后从缓冲区复制一次输出，
+    不为单个 box 生成中间副本。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # 缓冲区中当前初始化段或分片的起点，以及下一个待解析 box 的位置
+        self._start = 0
+        self._pos = 0
+        self.init_segment: Optional[bytes] = None
+        self.init_info: Optional[Dict] = None
+
+    def feed(self, data: bytes) -> List[Tuple[str, bytes]]:
+        """输入一段字节（bytes 或 memoryview），返回已完整的 ('init', bytes) 或 ('fragment', bytes) 列表"""
+        buffer = self._buffer
+        buffer += data
+        output = []
+        start, pos = self._start, self._pos
+        with memoryview(buffer) as view:
+            while len(buffer) - pos >= 8:
+                size, box_type = struct.unpack_from('>I4s', buffer, pos)
+                if size == 1:
+                    if len(buffer) - pos < 16:
+                        break
+                    size = struct.unpack_from('>Q', buffer, pos + 8)[0]
+                if size < 8 or len(buffer) - pos < size:
+                    break
+
+                if self.init_segment is None and (box_type == b'moof' or box_type in FRAGMENT_PREFIX_BOXES):
+                    # 第一个分片开始，之前累积的 ftyp/moov 就是初始化段
+                    self.init_segment = bytes(view[start:pos])
+                    self.init_info = parse_init_segment(self.init_segment)
+                    output.append(('init', self.init_segment))
+                    start = pos
+                pos += size
+                if box_type == b'mdat' and self.init_segment is not None:
+                    output.append(('fragment', bytes(view[start:pos])))
+                    start = pos
+        # 丢弃已经输出的数据（需要先释放 memoryview 才能改变 bytearray 大小）
+        if start:
+            del buffer[:start]
+            pos -= start
+            start = 0
+        self._start, self._pos = start, pos
+        return output
+
+    def flush(self) -> List[Tuple[str, bytes]]:
+        """流结束时输出剩余数据"""
+        output = []
+        rest = bytes(self._buffer[self._start:])
+        self._buffer = bytearray()
+        self._start = self._pos = 0
+        if rest:
+            if self.init_segment is None:
+                self.init_segment = rest
+                output.append(('init', rest))
+            else:
+                output.append(('fragment', rest))
+        return output
@@ -0,0 +1,189 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class FragmentCache:
+    """转码输出的本地磁盘缓存，按总大小做 LRU 淘汰
+
+    每个缓存项是一次完整推流的分片 MP4 输出（初始化段 + 全部分片），
+    键由源文件路径、大小、修改时间、偏移量和流模式组成。
+    多个 worker 共享同一个目录，各自维护 LRU 顺序，命中时以磁盘上的文件为准。
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        if self.enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _load(self) -> None:
+        """启动时扫描缓存目录，按最近访问时间恢复 LRU 顺序"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.part'):
+                # 上次异常退出遗留的临时文件
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith('.mp4'):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_atime, name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._total_bytes += size
+        self._evict()
+        logger.info(f"Fragment cache loaded: {len(self._entries)} entries, {self._total_bytes} bytes")
+
+    @staticmethod
+    def key_for(video_path: str, size: int, mtime: float, offset_seconds: float, profile: str) -> str:
+        """计算缓存键"""
+        raw = f"{video_path}|{size}|{mtime}|{offset_seconds:.3f}|{profile}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.mp4")
+
+    def lookup(self, key: str) -> Optional[str]:
+        """查找缓存，命中返回文件路径并更新 LRU 顺序"""
+        if not self.enabled:
+            return None
+        path = self.path_for(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                # 可能已被其他 worker 淘汰
+                if key in self._entries:
+                    self._total_bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            if key not in self._entries:
+                # 其他 worker 写入的缓存
+                self._entries[key] = size
+                self._total_bytes += size
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            now = time.time()
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        return path
+
+    def writer(self, key: str) -> 'CacheWriter':
+        """创建一个写入器，推流完成后提交为缓存项"""
+        return CacheWriter(self, key)
+
+    def _commit(self, key: str, tmp_path: str, size: int) -> None:
+        path = self.path_for(key)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)
+            self._entries[key] = size
+            self._total_bytes += size
+            self.stores += 1
+            self._evict()
+        logger.info(f"Cached stream output {key} ({size} bytes)")
+
+    def _evict(self) -> None:
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict:
+        """缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+            }
+
+
+class CacheWriter:
+    """作为 Broadcast 的监听器，把输出边推流边写入临时文件"""
+
+    def __init__(self, cache: FragmentCache, key: str):
+        self.cache = cache
+        self.key = key
+        self.tmp_path = os.path.join(cache.cache_dir, f"{key}.{uuid.uuid4().hex}.part")
+        self._file = open(self.tmp_path, 'wb')
+        self.size = 0
+
+    def __call__(self, kind: str, data: bytes) -> None:
+        if self._file is None:
+            return
+        if kind in ('init', 'fragment'):
+            self._file.write(data)
+            self.size += len(data)
+            if self.size > self.cache.max_bytes:
+                # 单个输出比整个缓存还大，放弃缓存
+                self.abort()
+        elif kind == 'complete':
+            self.commit()
+        elif kind == 'abort':
+            self.abort()
+
+    def commit(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        try:
+            self.cache._commit(self.key, self.tmp_path, self.size)
+        except OSError as e:
+            logger.error(f"Failed to commit cache entry {self.key}: {e}")
+            self._remove_tmp()
+
+    def abort(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._remove_tmp()
+
+    def _remove_tmp(self) -> None:
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
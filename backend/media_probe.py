@@ -0,0 +1,138 @@
+import json
+import logging
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 浏览器 <video> 可以直接播放的编码
+BROWSER_VIDEO_CODECS = {'h264'}
+BROWSER_PIX_FMTS = {'yuv420p', 'yuvj420p'}
+BROWSER_AUDIO_CODECS = {'aac', 'mp3'}
+
+# 支持的流模式
+STREAM_MODES = ('auto', 'copy', 'transcode')
+
+
+def probe_media(url: str, timeout: float = 15) -> Optional[Dict]:
+    """用 ffprobe 读取视频文件的编码信息
+
+    Args:
+        url: 文件 URL
+        timeout: ffprobe 超时时间（秒）
+
+    Returns:
+        包含 video_codec/pix_fmt/audio_codec 的字典，失败返回 None
+    """
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-timeout', '30000000',
+        '-seekable', '1',
+        '-show_entries', 'stream=codec_type,codec_name,pix_fmt',
+        '-of', 'json',
+        url
+    ]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        if result.returncode != 0:
+            logger.warning(f"ffprobe failed with return code {result.returncode}: "
+                           f"{result.stderr.decode('utf-8', 'replace').strip()}")
+            return None
+        streams = json.loads(result.stdout or b'{}').get('streams', [])
+    except (subprocess.TimeoutExpired, OSError, ValueError) as e:
+        logger.warning(f"ffprobe error: {str(e)}")
+        return None
+
+    info = {'video_codec': None, 'pix_fmt': None, 'audio_codec': None}
+    for stream in streams:
+        if stream.get('codec_type') == 'video' and info['video_codec'] is None:
+            info['video_codec'] = stream.get('codec_name')
+            info['pix_fmt'] = stream.get('pix_fmt')
+        elif stream.get('codec_type') == 'audio' and info['audio_codec'] is None:
+            info['audio_codec'] = stream.get('codec_name')
+    return info
+
+
+class ProbeCache:
+    """按文件缓存 ffprobe 结果的 LRU 缓存
+
+    缓存键包含文件大小和修改时间，正在录制的片段变化后会重新探测。
+    设置了 store（持久化的片段目录）时，探测结果同时保存到磁盘，worker 重启后不需要重新探测。
+    """
+
+    def __init__(self, max_entries: int = 4096, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self._entries: 'OrderedDict[Tuple, Dict]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, video_path: str, url: str, size: int = 0, mtime: float = 0.0) -> Optional[Dict]:
+        """获取文件的编码信息，未缓存时探测一次"""
+        key = (video_path, size, mtime)
+        with self._lock:
+            info = self._entries.get(key)
+            if info is not None:
+                self._entries.move_to_end(key)
+                return info
+
+        info = self._load(video_path, size, mtime)
+        if info is None:
+            info = probe_media(url)
+            if info is None:
+                return None
+            logger.info(f"Probed {video_path}: {info}")
+            self._save(video_path, size, mtime, info)
+
+        with self._lock:
+            self._entries[key] = info
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return info
+
+    def _load(self, video_path: str, size: int, mtime: float) -> Optional[Dict]:
+        if self.store is None:
+            return None
+        try:
+            return self.store.get_probe(video_path, size, mtime)
+        except Exception as e:
+            logger.error(f"Failed to read stored probe for {video_path}: {e}")
+            return None
+
+    def _save(self, video_path: str, size: int, mtime: float, info: Dict) -> None:
+        if self.store is None:
+            return
+        try:
+            self.store.set_probe(video_path, size, mtime, info)
+        except Exception as e:
+            logger.error(f"Failed to store probe for {video_path}: {e}")
+
+
+def plan_codecs(info: Optional[Dict], mode: str = 'auto') -> Tuple[bool, str]:
+    """根据编码信息决定视频/音频是直接复制还是转码
+
+    Args:
+        info: probe_media 返回的编码信息，None 表示未知
+        mode: 'auto' 按编码自动选择，'copy' 强制复制视频，'transcode' 强制转码
+
+    Returns:
+        (video_copy, audio_codec) 元组，audio_codec 为 'copy' 或 'aac'
+    """
+    if mode == 'transcode':
+        return False, 'aac'
+
+    video_copy = mode == 'copy'
+    audio_codec = 'aac'
+    if info is not None:
+        if info['video_codec'] in BROWSER_VIDEO_CODECS and info['pix_fmt'] in BROWSER_PIX_FMTS:
+            video_copy = True
+        if info['audio_codec'] in BROWSER_AUDIO_CODECS:
+            audio_codec = 'copy'
+    return video_copy, audio_codec
+
+
+# 进程内共享的探测缓存
+probe_cache = ProbeCache()
@@ -0,0 +1,426 @@
+import fcntl
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 延迟类指标的默认分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 字节数指标的分桶
+BYTES_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2,
+                 256 * 1024 ** 2, 1024 ** 3)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """指标基类，按标签值分别保存样本"""
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List:
+        """[(标签值, 值)]，可 JSON 序列化"""
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    """只增不减的计数"""
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """可增可减的当前值，也可以在采集时由回调函数计算"""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Optional[Callable[[], object]] = None
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], object]) -> None:
+        """采集时调用 function：没有标签时返回数值，有标签时返回 {标签值元组: 数值}"""
+        self._function = function
+
+    def samples(self) -> List:
+        if self._function is None:
+            return super().samples()
+        try:
+            result = self._function()
+        except Exception as e:
+            logger.error(f"Gauge {self.name} callback failed: {e}")
+            return []
+        if isinstance(result, dict):
+            return [[list(key) if isinstance(key, tuple) else [key], value] for key, value in result.items()]
+        return [[[], result]]
+
+
+class _Timer:
+    """Histogram.time() 返回的计时器，可作为上下文管理器或装饰器"""
+
+    def __init__(self, histogram: 'Histogram', labels: Dict[str, object]):
+        self._histogram = histogram
+        self._labels = labels
+        self._started = 0.0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Timer(self._histogram, self._labels):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+class Histogram(Metric):
+    """分桶统计，每组标签保存各桶计数、总和和次数"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各桶计数（非累计）, 总和, 次数]
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels) -> _Timer:
+        return _Timer(self, labels)
+
+    def samples(self) -> List:
+        with self._lock:
+            return [[list(key), [list(state[0]), state[1], state[2]]] for key, state in self._values.items()]
+
+
+class MetricsRegistry:
+    """指标注册表，输出 Prometheus 文本格式
+
+    多个 gunicorn worker 时每个 worker 定期把自己的样本写入共享目录，
+    采集时合并所有存活 worker 的样本（计数、分桶和当前值都按标签相加），
+    抓取请求落在任意 worker 上都能看到全部数据。
+    已退出 worker 的计数和分桶先累加到共享目录中的归档文件再删除它的样本文件，
+    worker 重启（例如 --max-requests）后合并的计数不会变小，Prometheus 不会误判为计数器重置；当前值不归档。
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+        self.shared_dir: Optional[str] = None
+        self._writer: Optional[threading.Thread] = None
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Duplicate metric {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> Dict[str, List]:
+        """本进程所有指标的样本"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.samples() for metric in metrics}
+
+    def enable_sharing(self, directory: str, interval: float = 5.0) -> None:
+        """在多个 worker 之间共享样本（只启动一次）
+
+        Args:
+            directory: 各 worker 写入样本文件的共享目录
+            interval: 写入间隔（秒）
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            if self._writer is not None:
+                return
+            self.shared_dir = directory
+            self._writer = threading.Thread(target=self._write_loop, args=(interval,), daemon=True)
+            self._writer.start()
+
+    def _snapshot_path(self, pid: int) -> str:
+        return os.path.join(self.shared_dir, f'{pid}.json')
+
+    def _archive_path(self) -> str:
+        return os.path.join(self.shared_dir, 'archive.json')
+
+    def _shared_lock(self, exclusive: bool):
+        """共享目录的进程间文件锁：归档退出的 worker 时独占，读取样本时共享"""
+        lock_file = open(os.path.join(self.shared_dir, 'archive.lock'), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lock_file
+
+    def _write_loop(self, interval: float) -> None:
+        while True:
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.error(f"Failed to write metrics snapshot: {e}")
+            time.sleep(interval)
+
+    def write_snapshot(self) -> None:
+        path = self._snapshot_path(os.getpid())
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, path)
+
+    def _snapshot_pids(self) -> List[int]:
+        pids = []
+        for name in os.listdir(self.shared_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                pids.append(int(name[:-5]))
+            except ValueError:
+                continue
+        return pids
+
+    @staticmethod
+    def _read_json(path: str) -> Optional[Dict[str, List]]:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _archive_exited(self, pids: List[int]) -> None:
+        """把已退出 worker 的计数和分桶累加到归档文件，然后删除它们的样本文件"""
+        with self._shared_lock(exclusive=True):
+            archive_path = self._archive_path()
+            snapshots = [self._read_json(archive_path) or {}]
+            paths = []
+            for pid in pids:
+                # 其他 worker 可能已经归档过
+                path = self._snapshot_path(pid)
+                snapshot = self._read_json(path)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+                    paths.append(path)
+            if not paths:
+                return
+            merged = self._merge(snapshots, archive=True)
+            temp_path = f'{archive_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump({name: [[list(key), value] for key, value in values.items()]
+                           for name, values in merged.items()}, f)
+            os.replace(temp_path, archive_path)
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        logger.info(f"Archived metrics of exited workers {pids}")
+
+    def _other_snapshots(self) -> List[Dict[str, List]]:
+        own_pid = os.getpid()
+        exited = []
+        for pid in self._snapshot_pids():
+            if pid == own_pid:
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                exited.append(pid)
+            except PermissionError:
+                pass
+        if exited:
+            self._archive_exited(exited)
+
+        # 读取期间持有共享锁，避免归档和删除样本文件之间读到一半，同一份计数被漏掉或重复合并
+        with self._shared_lock(exclusive=False):
+            snapshots = []
+            archive = self._read_json(self._archive_path())
+            if archive is not None:
+                snapshots.append(archive)
+            for pid in self._snapshot_pids():
+                if pid == own_pid:
+                    continue
+                snapshot = self._read_json(self._snapshot_path(pid))
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+        return snapshots
+
+    def collect(self) -> Dict[str, Dict[Tuple[str, ...], object]]:
+        """合并本进程、其他 worker 和已退出 worker 归档的样本"""
+        snapshots = [self.snapshot()]
+        if self.shared_dir:
+            snapshots.extend(self._other_snapshots())
+        return self._merge(snapshots)
+
+    def _merge(self, snapshots: List[Dict[str, List]],
+               archive: bool = False) -> Dict[str, Dict[Tuple[str, ...], object]]:
+        """按标签相加多份样本；archive 为 True 时只保留计数和分桶"""
+        merged: Dict[str, Dict[Tuple[str, ...], object]] = {}
+        for snapshot in snapshots:
+            for name, samples in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None or (archive and metric.type == 'gauge'):
+                    continue
+                values = merged.setdefault(name, {})
+                for key, value in samples:
+                    key = tuple(key)
+                    if metric.type == 'histogram':
+                        current = values.get(key)
+                        if current is None or len(current[0]) != len(value[0]):
+                            values[key] = [list(value[0]), value[1], value[2]]
+                        else:
+                            current[0] = [a + b for a, b in zip(current[0], value[0])]
+                            current[1] += value[1]
+                            current[2] += value[2]
+                    else:
+                        values[key] = values.get(key, 0) + value
+        return merged
+
+    def render(self) -> str:
+        """Prometheus 文本格式（0.0.4）"""
+        merged = self.collect()
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for key, value in sorted(merged.get(metric.name, {}).items()):
+                if metric.type == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets, value[0]):
+                        cumulative += count
+                        labels = _format_labels(metric.labelnames, key, ('le', _format_value(bound)))
+                        lines.append(f'{metric.name}_bucket{labels} {cumulative}')
+                    labels = _format_labels(metric.labelnames, key)
+                    lines.append(f'{metric.name}_sum{labels} {_format_value(value[1])}')
+                    lines.append(f'{metric.name}_count{labels} {value[2]}')
+                else:
+                    labels = _format_labels(metric.labelnames, key)
+                    lines.append(f'{metric.name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+# WebDAV（NAS）
+PROPFIND_SECONDS = REGISTRY.histogram(
+    'xiaomi_cctv_webdav_propfind_seconds', 'PROPFIND request duration including streaming parse', ['depth'])
+PROPFIND_ENTRIES = REGISTRY.histogram(
+    'xiaomi_cctv_webdav_propfind_entries', 'Entries returned by one PROPFIND request', ['depth'],
+    buckets=(1, 10, 100, 500, 1000, 2000, 5000, 10000, 20000, 50000))
+PROPFIND_ERRORS = REGISTRY.counter(
+    'xiaomi_cctv_webdav_propfind_errors_total', 'Failed PROPFIND requests')
+RANGE_READ_SECONDS = REGISTRY.histogram(
+    'xiaomi_cctv_webdav_range_read_seconds', 'Ranged GET duration for block cache and prefetch reads')
+RANGE_READ_BYTES = REGISTRY.counter(
+    'xiaomi_cctv_webdav_range_read_bytes_total', 'Bytes read from WebDAV with ranged GETs')
+
+# 片段查找和推流
+FIND_VIDEO_CHUNK_SECONDS = REGISTRY.histogram(
+    'xiaomi_cctv_find_video_chunk_seconds', 'Time to resolve a playback time to a segment file')
+STREAM_FIRST_CHUNK_SECONDS = REGISTRY.histogram(
+    'xiaomi_cctv_stream_first_chunk_seconds', 'Time from stream request to the first chunk handed to the client',
+    ['broadcast'])
+STREAM_BYTES = REGISTRY.histogram(
+    'xiaomi_cctv_stream_bytes', 'Bytes sent per stream', buckets=BYTES_BUCKETS)
+STREAM_THROUGHPUT = REGISTRY.histogram(
+    'xiaomi_cctv_stream_throughput_bits_per_second', 'Average throughput per stream',
+    buckets=(250e3, 500e3, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6, 64e6))
+STREAMS_FINISHED = REGISTRY.counter(
+    'xiaomi_cctv_streams_finished_total', 'Finished streams by outcome', ['outcome'])
+STREAMS_BY_QUALITY = REGISTRY.counter(
+    'xiaomi_cctv_streams_by_quality_total', 'Started streams by quality profile', ['quality'])
+RAW_SEGMENT_REQUESTS = REGISTRY.counter(
+    'xiaomi_cctv_raw_segment_requests_total', 'Raw segment proxy requests by response status', ['status'])
+RAW_SEGMENT_BYTES = REGISTRY.counter(
+    'xiaomi_cctv_raw_segment_bytes_total', 'Bytes sent by the raw segment proxy')
+SEEKS_SUPERSEDED = REGISTRY.counter(
+    'xiaomi_cctv_seeks_superseded_total', 'Playback requests dropped before FFmpeg launch because the client seeked again',
+    ['stage'])
+ACTIVE_STREAMS = REGISTRY.gauge(
+    'xiaomi_cctv_active_streams', 'Streams currently being served')
+ACTIVE_BROADCASTS = REGISTRY.gauge(
+    'xiaomi_cctv_active_broadcasts', 'Running shared FFmpeg broadcasts')
+
+# FFmpeg 和调度
+FFMPEG_FIRST_OUTPUT_SECONDS = REGISTRY.histogram(
+    'xiaomi_cctv_ffmpeg_first_output_seconds', 'Time from FFmpeg launch to its first stdout bytes')
+FFMPEG_EXITS = REGISTRY.counter(
+    'xiaomi_cctv_ffmpeg_exits_total', 'FFmpeg broadcast exits by return code', ['code', 'terminated'])
+TRANSCODE_SLOTS = REGISTRY.gauge(
+    'xiaomi_cctv_transcode_slots', 'Transcode scheduler tickets by state', ['state'])
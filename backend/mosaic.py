@@ -0,0 +1,110 @@
+import logging
+import math
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 马赛克输出的默认分辨率和帧率
+DEFAULT_MOSAIC_WIDTH = 1280
+DEFAULT_MOSAIC_HEIGHT = 720
+DEFAULT_MOSAIC_FPS = 10
+# 输出分辨率上限，防止一次请求占满编码器
+MAX_MOSAIC_WIDTH = 3840
+MAX_MOSAIC_HEIGHT = 2160
+
+
+def grid_layout(count: int) -> Tuple[int, int]:
+    """按摄像头数量选择网格的列数和行数，尽量接近正方形
+
+    Returns:
+        (cols, rows)
+    """
+    cols = max(1, math.ceil(math.sqrt(count)))
+    rows = max(1, math.ceil(count / cols))
+    return cols, rows
+
+
+def cell_size(width: int, height: int, cols: int, rows: int) -> Tuple[int, int]:
+    """每个格子的尺寸，取偶数以满足 yuv420p 的要求"""
+    return max(2, width // cols // 2 * 2), max(2, height // rows // 2 * 2)
+
+
+def build_mosaic_command(inputs: List[Optional[Dict]], width: int, height: int,
+                         fps: int = DEFAULT_MOSAIC_FPS) -> List[str]:
+    """构建多摄像头马赛克的 FFmpeg 命令：所有摄像头在同一个滤镜图中缩放、拼接，只编码一次
+
+    Args:
+        inputs: 按格子顺序排列的输入，每项包含 url（文件 URL 或 ffconcat 播放列表）、
+            offset（输入端跳转的秒数）和 concat（url 是否为播放列表）；该时刻没有录像的摄像头为 None，显示为黑色格子
+        width: 输出宽度
+        height: 输出高度
+        fps: 输出帧率，每个输入在拼接前统一到该帧率
+
+    Returns:
+        FFmpeg 命令参数列表
+    """
+    cols, rows = grid_layout(len(inputs))
+    cell_width, cell_height = cell_size(width, height, cols, rows)
+    canvas = f'{cell_width * cols}x{cell_height * rows}'
+
+    cmd = ['ffmpeg']
+    filters = []
+    positions = []
+    for cell, source in enumerate(inputs):
+        if source is None:
+            continue
+        if source.get('concat'):
+            cmd.extend([
+                '-f', 'concat',
+                '-safe', '0',
+                '-protocol_whitelist', 'file,http,https,tcp,tls,crypto',
+            ])
+        else:
+            cmd.extend([
+                '-timeout', '30000000',  # 30秒连接超时（微秒）
+                '-headers', 'User-Agent: FFmpeg',
+                '-seekable', '1',  # 强制使用 Range 请求跳转
+                '-multiple_requests', '1',
+            ])
+            if source.get('offset', 0) > 0:
+                cmd.extend(['-ss', f"{source['offset']:.3f}"])
+        cmd.extend(['-i', source['url']])
+        index = len(positions)
+        # 各路时间戳从 0 开始对齐；按比例缩放到格子内，不足的部分补黑边
+        filters.append(
+            f'[{index}:v:0]setpts=PTS-STARTPTS,'
+            f'scale={cell_width}:{cell_height}:force_original_aspect_ratio=decrease,'
+            f'pad={cell_width}:{cell_height}:(ow-iw)/2:(oh-ih)/2,'
+            f'fps={fps},setsar=1[v{index}]')
+        positions.append((cell % cols * cell_width, cell // cols * cell_height))
+
+    if not positions:
+        raise ValueError('Mosaic needs at least one camera with footage')
+    if len(positions) == 1:
+        # xstack 至少需要两路输入，只有一路时直接补边放到对应位置
+        x, y = positions[0]
+        filters.append(f'[v0]pad={cell_width * cols}:{cell_height * rows}:{x}:{y}:black,format=yuv420p[out]')
+    else:
+        # 没有录像的格子由 fill 填充黑色，xstack 只输出到最右下的输入为止，再补边到完整网格；先结束的摄像头停在最后一帧
+        layout = '|'.join(f'{x}_{y}' for x, y in positions)
+        stacked = ''.join(f'[v{i}]' for i in range(len(positions)))
+        filters.append(f'{stacked}xstack=inputs={len(positions)}:layout={layout}:fill=black,'
+                       f'pad={cell_width * cols}:{cell_height * rows}:0:0:black,format=yuv420p[out]')
+    logger.info(f"Mosaic grid {cols}x{rows}, canvas {canvas}, {len(positions)}/{len(inputs)} cameras with footage")
+
+    cmd.extend([
+        '-filter_complex', ';'.join(filters),
+        '-map', '[out]',
+        '-c:v', 'libx264',
+        '-preset', 'ultrafast',
+        '-tune', 'zerolatency',
+        '-force_key_frames', 'expr:gte(t,n_forced*2)',  # 每2秒一个关键帧，便于后加入的观看者快速开始
+        '-an',  # 多路声音混在一起没有意义
+        '-f', 'mp4',
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+        '-frag_duration', '1000000',
+        '-min_frag_duration', '1000000',
+        '-y',
+        'pipe:1'
+    ])
+    return cmd
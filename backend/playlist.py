@@ -0,0 +1,111 @@
+import logging
+import os
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 预取下一个片段开头的字节数，覆盖 ftyp/moov 和前几秒数据
+PREFETCH_HEAD_BYTES = int(os.getenv('PREFETCH_HEAD_BYTES', str(2 * 1024 * 1024)))
+
+
+def write_ffconcat(urls: List[str], inpoint: float = 0, outpoint: Optional[float] = None) -> str:
+    """生成 FFmpeg concat demuxer 的播放列表文件
+
+    Args:
+        urls: 按播放顺序排列的片段 URL
+        inpoint: 第一个片段内的起始偏移（秒）
+        outpoint: 最后一个片段内的结束偏移（秒），None 表示播放到片段结尾
+
+    Returns:
+        播放列表文件路径，使用完后由调用方删除
+    """
+    lines = ['ffconcat version 1.0']
+    for i, url in enumerate(urls):
+        lines.append("file '{}'".format(url.replace("'", "'\\''")))
+        if i == 0 and inpoint > 0:
+            lines.append(f'inpoint {inpoint:.3f}')
+        if i == len(urls) - 1 and outpoint is not None:
+            lines.append(f'outpoint {outpoint:.3f}')
+    fd, path = tempfile.mkstemp(prefix='xiaomi_cctv_', suffix='.ffconcat')
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+    return path
+
+
+class SegmentPrefetcher:
+    """连续播放时预取下一个片段的开头
+
+    根据 FFmpeg -progress 输出的 out_time_us 推算当前播放到第几个片段，
+    进入第 k 个片段时在后台预取第 k+1 个片段开头的 PREFETCH_HEAD_BYTES 字节，
+    让 NAS 和 keep-alive 连接在切换片段前就准备好。
+    """
+
+    def __init__(self, segments: List[Dict], inpoint: float, playback_rate: float,
+                 fetch: Callable[[Dict, int], None]):
+        """
+        Args:
+            segments: 片段列表，每项包含 path/start_time/end_time/size/mtime
+            inpoint: 第一个片段内的起始偏移（秒）
+            playback_rate: 播放速率，用于把输出时间换算回源时间
+            fetch: fetch(segment, length) 读取片段开头 length 字节
+        """
+        self.segments = segments
+        self.playback_rate = playback_rate
+        self._fetch = fetch
+        self._next_prefetch = 1
+        self._lock = threading.Lock()
+        # 每个片段在输出中开始的源时间（秒）
+        self._boundaries = []
+        elapsed = 0.0
+        for i, segment in enumerate(segments):
+            self._boundaries.append(elapsed)
+            duration = (segment['end_time'] - segment['start_time']).total_seconds()
+            elapsed += max(0.0, duration - (inpoint if i == 0 else 0))
+
+    def start(self) -> None:
+        """开始播放时先预取第二个片段"""
+        self._prefetch_up_to(0)
+
+    def on_progress_line(self, line: str) -> bool:
+        """处理一行 FFmpeg 进度输出，是进度行时返回 True"""
+        if not line.startswith('out_time_us='):
+            return line.startswith(('frame=', 'fps=', 'stream_', 'bitrate=', 'total_size=', 'out_time',
+                                    'dup_frames=', 'drop_frames=', 'speed=', 'progress='))
+        try:
+            source_elapsed = int(line.split('=', 1)[1]) / 1e6 * self.playback_rate
+        except ValueError:
+            return True
+        current = 0
+        for i, boundary in enumerate(self._boundaries):
+            if source_elapsed >= boundary:
+                current = i
+        self._prefetch_up_to(current)
+        return True
+
+    def _prefetch_up_to(self, current: int) -> None:
+        with self._lock:
+            targets = []
+            while self._next_prefetch <= current + 1 and self._next_prefetch < len(self.segments):
+                targets.append(self.segments[self._next_prefetch])
+                self._next_prefetch += 1
+        for segment in targets:
+            threading.Thread(target=self._run_fetch, args=(segment,), daemon=True).start()
+
+    def _run_fetch(self, segment: Dict) -> None:
+        try:
+            self._fetch(segment, PREFETCH_HEAD_BYTES)
+            logger.info(f"Prefetched head of next segment: {segment['path']}")
+        except Exception as e:
+            logger.warning(f"Prefetch failed for {segment['path']}: {e}")
+
+
+def remove_file(path: Optional[str]) -> None:
+    """删除临时文件，忽略不存在的情况"""
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 画质档位：height 为输出高度上限（None 表示源分辨率），video_bitrate/audio_bitrate 为码率上限（kbit/s），
+# audio 为 False 时去掉音轨。source 保持原有行为，源编码兼容时直接复制
+QUALITY_PROFILES: Dict[str, Dict] = {
+    'source': {'height': None, 'video_bitrate': None, 'audio_bitrate': 128, 'audio': True},
+    'audio-off': {'height': None, 'video_bitrate': None, 'audio_bitrate': None, 'audio': False},
+    '1080p': {'height': 1080, 'video_bitrate': 4000, 'audio_bitrate': 128, 'audio': True},
+    '720p': {'height': 720, 'video_bitrate': 2000, 'audio_bitrate': 96, 'audio': True},
+    '480p': {'height': 480, 'video_bitrate': 1000, 'audio_bitrate': 64, 'audio': True},
+    '360p': {'height': 360, 'video_bitrate': 600, 'audio_bitrate': 48, 'audio': True},
+}
+# auto 按客户端实测吞吐量从高到低选择的档位
+AUTO_LADDER = ('1080p', '720p', '480p', '360p')
+AUTO_QUALITY = 'auto'
+
+# 选择档位时给链路留出的余量：档位总码率不超过实测吞吐量的这一比例
+AUTO_HEADROOM = 0.7
+# 按该时长的时间窗口统计写出的字节数和阻塞时间
+SAMPLE_WINDOW_SECONDS = 2.0
+# 窗口内阻塞在写出上的时间占比达到该值，才认为链路是瓶颈，此时的写出速率就是链路吞吐量
+CONGESTED_FRACTION = 0.5
+# 超过该时间没有再观察到链路瓶颈时丢弃估计值，重新按源画质开始
+ESTIMATE_MAX_AGE = 300
+# 指数加权的新样本权重
+EWMA_WEIGHT = 0.5
+
+
+def profile_bitrate(name: str) -> Optional[int]:
+    """档位的总码率上限（kbit/s），源画质为 None"""
+    profile = QUALITY_PROFILES[name]
+    if profile['video_bitrate'] is None:
+        return None
+    return profile['video_bitrate'] + (profile['audio_bitrate'] if profile['audio'] else 0)
+
+
+class ThroughputTracker:
+    """按客户端估计下行链路吞吐量
+
+    推流生成器每交出一个分片都会阻塞到数据写入 socket；链路比视频码率快时几乎不阻塞，
+    链路跟不上时大部分时间都阻塞在写出上。按时间窗口统计每个流的阻塞时间占比，
+    连续两个窗口都阻塞时 socket 缓冲区在两端都是满的，这段时间写出的字节数就是链路实际送达的字节数，
+    “字节数 / 时长”即链路吞吐量；开始时灌满缓冲区的那部分数据不计入。
+    样本按客户端指数加权平滑后供 auto 画质选择使用。
+    """
+
+    def __init__(self, max_clients: int = 1000):
+        self.max_clients = max_clients
+        self._clients: OrderedDict = OrderedDict()
+        self._streams: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, client_id: str, stream_id: str, size: int, blocked_seconds: float) -> None:
+        """记录一次分片写出：size 字节在 yield 中阻塞了 blocked_seconds 秒"""
+        now = time.monotonic()
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                stream = {'bytes': 0, 'window_start': now - blocked_seconds, 'blocked': 0.0, 'anchor': None}
+                self._streams[stream_id] = stream
+            stream['bytes'] += size
+            stream['blocked'] += blocked_seconds
+            elapsed = now - stream['window_start']
+            if elapsed < SAMPLE_WINDOW_SECONDS:
+                return
+            congested = stream['blocked'] >= elapsed * CONGESTED_FRACTION
+            stream['window_start'] = now
+            stream['blocked'] = 0.0
+            if not congested:
+                # 缓冲区可能已经排空，重新等待链路成为瓶颈
+                stream['anchor'] = None
+                return
+            anchor = stream['anchor']
+            stream['anchor'] = (now, stream['bytes'])
+            if anchor is None:
+                return
+            sample = (stream['bytes'] - anchor[1]) * 8 / (now - anchor[0])
+            self._update(client_id, sample)
+
+    def finish(self, stream_id: str) -> None:
+        """流结束时丢弃它的窗口状态"""
+        with self._lock:
+            self._streams.pop(stream_id, None)
+
+    def _update(self, client_id: str, sample: float) -> None:
+        state = self._clients.get(client_id)
+        if state is None:
+            state = {'bps': sample, 'updated_at': 0.0}
+            self._clients[client_id] = state
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        else:
+            state['bps'] = EWMA_WEIGHT * sample + (1 - EWMA_WEIGHT) * state['bps']
+        self._clients.move_to_end(client_id)
+        state['updated_at'] = time.time()
+        logger.info(f"Client {client_id} link throughput estimate: {state['bps'] / 1000:.0f} kbit/s")
+
+    def estimate(self, client_id: str) -> Optional[float]:
+        """客户端链路吞吐量估计（bit/s），没有观察到链路瓶颈时为 None"""
+        with self._lock:
+            state = self._clients.get(client_id)
+            if not state or state['bps'] is None or time.time() - state['updated_at'] > ESTIMATE_MAX_AGE:
+                return None
+            return state['bps']
+
+    def choose(self, client_id: str) -> str:
+        """auto 画质：没有观察到链路瓶颈时用源画质，否则选择码率能放进链路的最高档位"""
+        bps = self.estimate(client_id)
+        if bps is None:
+            return 'source'
+        for name in AUTO_LADDER:
+            if profile_bitrate(name) * 1000 <= bps * AUTO_HEADROOM:
+                return name
+        return AUTO_LADDER[-1]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'clients': {client_id: {
+                    'kbps': round(state['bps'] / 1000),
+                    'updated_at': state['updated_at'],
+                } for client_id, state in self._clients.items()},
+                'tracked_streams': len(self._streams),
+            }
+
+
+# 进程内共享的吞吐量估计
+throughput_tracker = ThroughputTracker()
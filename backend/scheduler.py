@@ -0,0 +1,218 @@
+import bisect
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 优先级，数值越小越先执行
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+class SchedulerBusy(Exception):
+    """排队已满或等待超时"""
+
+    def __init__(self, message: str, queue_position: Optional[int] = None):
+        super().__init__(message)
+        self.queue_position = queue_position
+
+
+class Ticket:
+    """一次 FFmpeg 启动的名额申请"""
+
+    def __init__(self, seq: int, camera: str, client: str, priority: int):
+        self.seq = seq
+        self.camera = camera
+        self.client = client
+        self.priority = priority
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        # queued -> running -> released，或 queued -> cancelled
+        self.state = 'queued'
+        # 名额已交给 Broadcast，随 FFmpeg 结束释放
+        self.attached = False
+        self._event = threading.Event()
+
+    @property
+    def sort_key(self):
+        return self.priority, self.seq
+
+
+class TranscodeScheduler:
+    """FFmpeg 启动的准入控制
+
+    同时运行的 FFmpeg 数量受全局、每个摄像头和每个客户端三级限制。
+    后台任务另有自己的并发上限，并且只使用空闲的全局和摄像头名额；交互申请在全局和摄像头两级只和其他交互申请比较，
+    已经运行的后台任务不会让播放排队超时。
+    超出限制的申请按优先级排队，交互播放优先于后台任务；带客户端标识的新申请
+    会取消同一客户端在同一摄像头上还在排队的旧申请（快速拖动进度条时只保留最后一次），等待超时的申请被取消，
+    由调用方返回“繁忙”而不是让所有流一起变慢。
+    """
+
+    def __init__(self, global_limit: int = 4, camera_limit: int = 2, client_limit: int = 2, max_queue: int = 20,
+                 background_limit: int = 1):
+        """
+        Args:
+            global_limit: 全局同时运行的上限
+            camera_limit: 每个摄像头同时运行的上限
+            client_limit: 每个客户端同时运行的上限
+            max_queue: 交互申请的最大排队数，超过时直接返回繁忙
+            background_limit: 后台任务同时运行的上限，交互播放占满名额时最多额外多出这么多个进程
+        """
+        self.global_limit = global_limit
+        self.camera_limit = camera_limit
+        self.client_limit = client_limit
+        self.background_limit = background_limit
+        self.max_queue = max_queue
+        self._queue: List = []
+        self._running: Dict[int, Ticket] = {}
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    def request(self, camera: str, client: str, priority: int = PRIORITY_INTERACTIVE,
+                supersede: bool = False) -> Ticket:
+        """提交申请，有空闲名额时立即进入运行状态
+
+        Args:
+            camera: 摄像头标识
+            client: 客户端标识
+            priority: 优先级
+            supersede: 是否取消同一客户端在同一摄像头上还在排队的旧申请，
+                只有客户端标识可靠（不是共享的 IP 地址）时才应启用
+
+        Raises:
+            SchedulerBusy: 交互申请排队已满
+        """
+        with self._lock:
+            ticket = Ticket(next(self._seq), camera, client, priority)
+            if supersede:
+                # 同一客户端在同一摄像头上的旧申请已经过时
+                for _, _, queued in list(self._queue):
+                    if queued.client == client and queued.camera == camera and queued.priority == priority:
+                        self._cancel(queued)
+                        logger.info(f"Cancelled superseded transcode request {queued.seq} from {client}")
+            if priority <= PRIORITY_INTERACTIVE:
+                interactive = sum(1 for _, _, queued in self._queue if queued.priority <= PRIORITY_INTERACTIVE)
+                if interactive >= self.max_queue:
+                    self.rejected += 1
+                    raise SchedulerBusy('Transcode queue is full', interactive + 1)
+            bisect.insort(self._queue, (*ticket.sort_key, ticket))
+            self._dispatch()
+            return ticket
+
+    def wait(self, ticket: Ticket, timeout: Optional[float] = None) -> None:
+        """等待申请进入运行状态
+
+        Args:
+            ticket: request 返回的申请
+            timeout: 最长等待秒数，None 表示一直等待
+
+        Raises:
+            SchedulerBusy: 等待超时或申请已被取消，超时的申请会被移出队列
+        """
+        ticket._event.wait(timeout)
+        with self._lock:
+            if ticket.state == 'running':
+                return
+            position = self._position(ticket)
+            if ticket.state == 'queued':
+                self._cancel(ticket)
+                self.rejected += 1
+        if ticket.state == 'cancelled' and position is None:
+            raise SchedulerBusy('Transcode request was superseded')
+        raise SchedulerBusy('Timed out waiting for a transcode slot', position)
+
+    def release(self, ticket: Ticket) -> None:
+        """释放名额（可重复调用），并启动排队中的申请"""
+        with self._lock:
+            if ticket.state == 'running':
+                self._running.pop(ticket.seq, None)
+                ticket.state = 'released'
+                self._dispatch()
+            elif ticket.state == 'queued':
+                self._cancel(ticket)
+
+    def position(self, ticket: Ticket) -> Optional[int]:
+        """申请在队列中的位置（从 1 开始），不在队列中时返回 None"""
+        with self._lock:
+            return self._position(ticket)
+
+    def _position(self, ticket: Ticket) -> Optional[int]:
+        for i, (_, _, queued) in enumerate(self._queue):
+            if queued is ticket:
+                return i + 1
+        return None
+
+    def _cancel(self, ticket: Ticket) -> None:
+        # 调用方持有 _lock
+        try:
+            self._queue.remove((*ticket.sort_key, ticket))
+        except ValueError:
+            pass
+        ticket.state = 'cancelled'
+        self.cancelled += 1
+        ticket._event.set()
+
+    def _can_run(self, ticket: Ticket) -> bool:
+        running = list(self._running.values())
+        if sum(1 for other in running if other.client == ticket.client) >= self.client_limit:
+            return False
+        if ticket.priority > PRIORITY_INTERACTIVE:
+            # 后台任务受自己的上限限制，并且只在全局和该摄像头都有空闲名额时运行
+            if sum(1 for other in running if other.priority > PRIORITY_INTERACTIVE) >= self.background_limit:
+                return False
+        else:
+            # 交互申请不计入正在运行的后台任务
+            running = [other for other in running if other.priority <= PRIORITY_INTERACTIVE]
+        if len(running) >= self.global_limit:
+            return False
+        if sum(1 for other in running if other.camera == ticket.camera) >= self.camera_limit:
+            return False
+        return True
+
+    def _dispatch(self) -> None:
+        # 调用方持有 _lock；按优先级依次检查，被限制挡住的申请不阻塞后面的申请
+        for item in list(self._queue):
+            ticket = item[2]
+            if self._can_run(ticket):
+                self._queue.remove(item)
+                ticket.state = 'running'
+                ticket.started_at = time.time()
+                self._running[ticket.seq] = ticket
+                self.admitted += 1
+                ticket._event.set()
+
+    def stats(self) -> Dict:
+        """调度器状态"""
+        with self._lock:
+            now = time.time()
+            return {
+                'limits': {
+                    'global': self.global_limit,
+                    'per_camera': self.camera_limit,
+                    'per_client': self.client_limit,
+                    'max_queue': self.max_queue,
+                    'background': self.background_limit,
+                },
+                'running': [{
+                    'camera': ticket.camera,
+                    'client': ticket.client,
+                    'priority': ticket.priority,
+                    'seconds': round(now - ticket.started_at, 1),
+                } for ticket in self._running.values()],
+                'queued': [{
+                    'camera': ticket.camera,
+                    'client': ticket.client,
+                    'priority': ticket.priority,
+                    'waiting_seconds': round(now - ticket.created_at, 1),
+                } for _, _, ticket in self._queue],
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'cancelled': self.cancelled,
+            }
@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Seek:
+    """一个客户端会话中的一次跳转（播放请求）"""
+
+    def __init__(self, session: Tuple[str, str], generation: int, video_path: str, offset_seconds: float,
+                 rapid: bool, same_segment: bool):
+        self.session = session
+        self.generation = generation
+        self.video_path = video_path
+        self.offset_seconds = offset_seconds
+        self.created_at = time.time()
+        # 距离上一次跳转不到合并窗口，用户可能还在拖动进度条
+        self.rapid = rapid
+        # 和上一次跳转在同一个片段内
+        self.same_segment = same_segment
+
+
+class SeekCoalescer:
+    """合并同一客户端会话（客户端 ID + 摄像头目录）的快速跳转
+
+    每个播放请求登记为该会话的最新跳转。距离上一次跳转不到 window 秒时认为用户正在拖动进度条，
+    请求先等待 window 秒，期间有更新的跳转到达就直接放弃，不申请名额也不启动 FFmpeg；
+    排队拿到名额后、真正启动 FFmpeg 前再检查一次。拖动结束时只有最后一次跳转会启动转码。
+    """
+
+    def __init__(self, window: float = 0.3, max_sessions: int = 1000):
+        """
+        Args:
+            window: 合并窗口（秒），0 表示不等待，只在启动前检查
+            max_sessions: 最多记录的会话数，超过时丢弃最久没有跳转的会话
+        """
+        self.window = window
+        self.max_sessions = max_sessions
+        # 会话 -> (最新跳转的序号, 时间, 片段路径)
+        self._sessions: 'OrderedDict[Tuple[str, str], Tuple[int, float, str]]' = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.seeks = 0
+        self.rapid = 0
+        self.superseded = 0
+
+    def begin(self, client_id: str, video_dir: str, video_path: str, offset_seconds: float) -> Seek:
+        """登记一次跳转，之前的跳转从此被取代"""
+        session = (client_id, video_dir)
+        now = time.time()
+        with self._lock:
+            self._generation += 1
+            previous = self._sessions.get(session)
+            rapid = previous is not None and now - previous[1] < self.window
+            same_segment = previous is not None and previous[2] == video_path
+            self._sessions[session] = (self._generation, now, video_path)
+            self._sessions.move_to_end(session)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            self.seeks += 1
+            if rapid:
+                self.rapid += 1
+            return Seek(session, self._generation, video_path, offset_seconds, rapid, same_segment)
+
+    def is_current(self, seek: Seek) -> bool:
+        """是否仍是该会话的最新跳转"""
+        with self._lock:
+            latest = self._sessions.get(seek.session)
+            return latest is None or latest[0] == seek.generation
+
+    def settle(self, seek: Seek) -> bool:
+        """快速连续跳转时等待合并窗口，返回等待后是否仍是最新跳转"""
+        if seek.rapid and self.window > 0:
+            time.sleep(max(0.0, seek.created_at + self.window - time.time()))
+        return self.check(seek)
+
+    def check(self, seek: Seek) -> bool:
+        """is_current，被取代时计入统计"""
+        if self.is_current(seek):
+            return True
+        with self._lock:
+            self.superseded += 1
+        logger.info(f"Seek to {seek.video_path}@{seek.offset_seconds:.1f}s for {seek.session[0]} "
+                    f"superseded before launch")
+        return False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'window': self.window,
+                'sessions': len(self._sessions),
+                'seeks': self.seeks,
+                'rapid': self.rapid,
+                'superseded': self.superseded,
+            }
@@ -0,0 +1,286 @@
+import json
+import logging
+import os
+import posixpath
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .blocking import call_blocking
+
+logger = logging.getLogger(__name__)
+
+# 时间以本地时间文本保存，字典序即时间顺序
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class SegmentCatalog:
+    """持久化的片段目录（SQLite 文件），所有 worker 共享
+
+    按摄像头目录保存每个片段的文件名、开始/结束时间、大小、修改时间和探测到的编码信息，
+    以 (video_dir, start_time) 建索引。片段索引刷新时把目录列表的增量写入这里，
+    worker 重启后直接从这里恢复索引，首次跳转不需要再向 NAS 列目录；
+    其他 worker 刚列过的目录也直接从这里读取。
+    片段的画面变化事件和分析状态也保存在这里，片段被删除时一起删除。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS segments (
+                    video_dir TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    start_time TEXT NOT NULL,
+                    end_time TEXT NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    mtime REAL NOT NULL DEFAULT 0,
+                    probe TEXT,
+                    probe_size INTEGER,
+                    probe_mtime REAL,
+                    PRIMARY KEY (video_dir, filename)
+                )''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS segments_start ON segments (video_dir, start_time)')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS listings (
+                    video_dir TEXT PRIMARY KEY,
+                    listed_at REAL NOT NULL
+                )''')
+            # 每个片段的分析状态：running 由某个 worker 认领，done/failed 记录分析时的大小和修改时间
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS event_scans (
+                    video_dir TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (video_dir, filename)
+                )''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS events (
+                    video_dir TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    start_time TEXT NOT NULL,
+                    end_time TEXT NOT NULL,
+                    score REAL NOT NULL
+                )''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS events_start ON events (video_dir, start_time)')
+
+    def _run(self, fn):
+        """持有锁执行数据库操作 fn(conn)
+
+        gevent worker 中在原生线程里执行：BEGIN IMMEDIATE 等其他 worker 的写锁时不会停住本 worker 的所有协程。
+        """
+        with self._lock:
+            return call_blocking(fn, self._conn)
+
+    def listed_at(self, video_dir: str) -> float:
+        """目录最近一次（任意 worker）列目录的时间，没有记录时为 0"""
+        row = self._run(lambda conn: conn.execute('SELECT listed_at FROM listings WHERE video_dir = ?',
+                                                  (video_dir,)).fetchone())
+        return row[0] if row else 0.0
+
+    def load(self, video_dir: str) -> Tuple[float, List[Tuple[datetime, datetime, str, int, float]]]:
+        """读取目录的全部片段
+
+        Returns:
+            (listed_at, [(start_time, end_time, filename, size, mtime)])，按开始时间排序
+        """
+        def read(conn):
+            row = conn.execute('SELECT listed_at FROM listings WHERE video_dir = ?', (video_dir,)).fetchone()
+            rows = conn.execute('SELECT start_time, end_time, filename, size, mtime FROM segments '
+                                'WHERE video_dir = ? ORDER BY start_time, end_time, filename',
+                                (video_dir,)).fetchall()
+            return row, rows
+        row, rows = self._run(read)
+        parse = datetime.fromisoformat
+        return (row[0] if row else 0.0,
+                [(parse(start), parse(end), name, size, mtime) for start, end, name, size, mtime in rows])
+
+    def apply(self, video_dir: str, upserts: Iterable[Tuple[str, datetime, datetime, int, float]],
+              removed: Iterable[str], listed_at: Optional[float] = None) -> None:
+        """写入一次目录列表的增量
+
+        Args:
+            video_dir: 摄像头目录
+            upserts: 新增或大小/修改时间变化的片段 (filename, start_time, end_time, size, mtime)
+            removed: 已删除的文件名
+            listed_at: 列目录的时间
+        """
+        rows = [(video_dir, name, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT), size, mtime)
+                for name, start, end, size, mtime in upserts]
+        removed = [(video_dir, name) for name in removed]
+        listed_at = listed_at or time.time()
+
+        def write(conn):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if rows:
+                    # 已探测的编码信息保留，按 probe_size/probe_mtime 判断是否仍然有效
+                    conn.executemany(
+                        'INSERT INTO segments (video_dir, filename, start_time, end_time, size, mtime) '
+                        'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (video_dir, filename) DO UPDATE SET '
+                        'start_time = excluded.start_time, end_time = excluded.end_time, '
+                        'size = excluded.size, mtime = excluded.mtime', rows)
+                if removed:
+                    conn.executemany('DELETE FROM segments WHERE video_dir = ? AND filename = ?', removed)
+                    conn.executemany('DELETE FROM event_scans WHERE video_dir = ? AND filename = ?', removed)
+                    conn.executemany('DELETE FROM events WHERE video_dir = ? AND filename = ?', removed)
+                conn.execute('INSERT INTO listings (video_dir, listed_at) VALUES (?, ?) '
+                             'ON CONFLICT (video_dir) DO UPDATE SET listed_at = excluded.listed_at',
+                             (video_dir, listed_at))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        self._run(write)
+
+    def get_probe(self, video_path: str, size: int, mtime: float) -> Optional[Dict]:
+        """读取已探测的编码信息，文件大小或修改时间变化后视为无效"""
+        video_dir, filename = posixpath.split(video_path)
+        row = self._run(lambda conn: conn.execute('SELECT probe, probe_size, probe_mtime FROM segments '
+                                                  'WHERE video_dir = ? AND filename = ?',
+                                                  (video_dir.rstrip('/'), filename)).fetchone())
+        if not row or row[0] is None or row[1] != size or row[2] != mtime:
+            return None
+        return json.loads(row[0])
+
+    def set_probe(self, video_path: str, size: int, mtime: float, info: Dict) -> None:
+        """保存编码信息（片段不在目录中时忽略）"""
+        video_dir, filename = posixpath.split(video_path)
+        params = (json.dumps(info), size, mtime, video_dir.rstrip('/'), filename)
+        self._run(lambda conn: conn.execute('UPDATE segments SET probe = ?, probe_size = ?, probe_mtime = ? '
+                                            'WHERE video_dir = ? AND filename = ?', params))
+
+    def event_scan_states(self, video_dir: str, filenames: List[str]) -> Dict[str, Tuple[str, int, float, float]]:
+        """读取片段的分析状态
+
+        Returns:
+            {filename: (status, size, mtime, updated_at)}，没有分析过的片段不在结果中
+        """
+        def read(conn):
+            states = {}
+            # SQLite 单条语句的参数个数有限，分批查询
+            for i in range(0, len(filenames), 500):
+                batch = filenames[i:i + 500]
+                rows = conn.execute(
+                    'SELECT filename, status, size, mtime, updated_at FROM event_scans WHERE video_dir = ? '
+                    f'AND filename IN ({",".join("?" * len(batch))})', (video_dir, *batch)).fetchall()
+                states.update({name: (status, size, mtime, updated_at) for name, status, size, mtime, updated_at in rows})
+            return states
+        return self._run(read)
+
+    def claim_event_scan(self, video_dir: str, filename: str, size: int, mtime: float, stale_after: float) -> bool:
+        """认领一个片段的分析任务，多个 worker 中只有一个能认领成功
+
+        已按相同大小和修改时间分析完成、或其他 worker 正在分析（未超过 stale_after 秒）时返回 False。
+        """
+        now = time.time()
+
+        def claim(conn):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT status, size, mtime, updated_at FROM event_scans '
+                                   'WHERE video_dir = ? AND filename = ?', (video_dir, filename)).fetchone()
+                if row is not None:
+                    status, scanned_size, scanned_mtime, updated_at = row
+                    if status == 'running' and now - updated_at < stale_after:
+                        conn.execute('COMMIT')
+                        return False
+                    if status == 'done' and scanned_size == size and scanned_mtime == mtime:
+                        conn.execute('COMMIT')
+                        return False
+                conn.execute('INSERT INTO event_scans (video_dir, filename, size, mtime, status, updated_at) '
+                             "VALUES (?, ?, ?, ?, 'running', ?) ON CONFLICT (video_dir, filename) DO UPDATE SET "
+                             'size = excluded.size, mtime = excluded.mtime, status = excluded.status, '
+                             'updated_at = excluded.updated_at', (video_dir, filename, size, mtime, now))
+                conn.execute('COMMIT')
+                return True
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return self._run(claim)
+
+    def save_events(self, video_dir: str, filename: str, size: int, mtime: float,
+                    events: Iterable[Tuple[datetime, datetime, float]]) -> None:
+        """保存一个片段的分析结果（替换之前的事件）"""
+        rows = [(video_dir, filename, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT), score)
+                for start, end, score in events]
+
+        def write(conn):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM events WHERE video_dir = ? AND filename = ?', (video_dir, filename))
+                if rows:
+                    conn.executemany('INSERT INTO events (video_dir, filename, start_time, end_time, score) '
+                                     'VALUES (?, ?, ?, ?, ?)', rows)
+                conn.execute('INSERT INTO event_scans (video_dir, filename, size, mtime, status, updated_at) '
+                             "VALUES (?, ?, ?, ?, 'done', ?) ON CONFLICT (video_dir, filename) DO UPDATE SET "
+                             'size = excluded.size, mtime = excluded.mtime, status = excluded.status, '
+                             'updated_at = excluded.updated_at', (video_dir, filename, size, mtime, time.time()))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        self._run(write)
+
+    def fail_event_scan(self, video_dir: str, filename: str) -> None:
+        """标记分析失败，失败的片段在重试间隔之后才会重新分析"""
+        params = (time.time(), video_dir, filename)
+        self._run(lambda conn: conn.execute("UPDATE event_scans SET status = 'failed', updated_at = ? "
+                                            'WHERE video_dir = ? AND filename = ?', params))
+
+    def events_between(self, video_dir: str, start: datetime, end: datetime) -> List[Tuple[datetime, datetime, float, str]]:
+        """与 [start, end) 有重叠的事件，按开始时间排序
+
+        Returns:
+            [(start_time, end_time, score, filename)]
+        """
+        params = (video_dir, end.strftime(TIME_FORMAT), start.strftime(TIME_FORMAT))
+        rows = self._run(lambda conn: conn.execute('SELECT start_time, end_time, score, filename FROM events '
+                                                   'WHERE video_dir = ? AND start_time < ? AND end_time >= ? '
+                                                   'ORDER BY start_time', params).fetchall())
+        parse = datetime.fromisoformat
+        return [(parse(event_start), parse(event_end), score, name) for event_start, event_end, score, name in rows]
+
+    def adjacent_event(self, video_dir: str, target: datetime,
+                       forward: bool = True) -> Optional[Tuple[datetime, datetime, float, str]]:
+        """target 之后（forward）或之前最近的一个事件的 (start_time, end_time, score, filename)"""
+        if forward:
+            sql = ('SELECT start_time, end_time, score, filename FROM events WHERE video_dir = ? AND start_time > ? '
+                   'ORDER BY start_time LIMIT 1')
+        else:
+            sql = ('SELECT start_time, end_time, score, filename FROM events WHERE video_dir = ? AND start_time < ? '
+                   'ORDER BY start_time DESC LIMIT 1')
+        params = (video_dir, target.strftime(TIME_FORMAT))
+        row = self._run(lambda conn: conn.execute(sql, params).fetchone())
+        if row is None:
+            return None
+        return datetime.fromisoformat(row[0]), datetime.fromisoformat(row[1]), row[2], row[3]
+
+    def stats(self) -> Dict:
+        rows = self._run(lambda conn: conn.execute('SELECT s.video_dir, COUNT(*), COUNT(s.probe), MIN(s.start_time), '
+                                                   'MAX(s.end_time), l.listed_at FROM segments s '
+                                                   'LEFT JOIN listings l ON l.video_dir = s.video_dir '
+                                                   'GROUP BY s.video_dir').fetchall())
+        return {
+            'path': self.path,
+            'directories': [{
+                'video_dir': video_dir,
+                'segments': count,
+                'probed': probed,
+                'first': first,
+                'last': last,
+                'listed_at': listed_at,
+            } for video_dir, count, probed, first, last, listed_at in rows],
+        }
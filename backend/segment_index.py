@@ -0,0 +1,415 @@
+import base64
+import bisect
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 当目标时间晚于索引中最后一个片段时，两次强制刷新之间的最小间隔（秒）
+MIN_REFRESH_INTERVAL = 5.0
+
+# 相邻片段间隔不超过该秒数时视为连续录像
+COVERAGE_MERGE_GAP = 2
+# 每个索引缓存的天数
+COVERAGE_CACHE_DAYS = 400
+
+
+def parse_segment_times(filename: str) -> Optional[Tuple[datetime, datetime]]:
+    """快速解析视频片段文件名中的开始和结束时间
+
+    只做定长切片和整数转换，不调用 strptime，用于批量构建索引。
+
+    Args:
+        filename: 视频文件名（格式：00_YYYYMMDDHHMMSS_YYYYMMDDHHMMSS.mp4 或 YYYYMMDDHHMMSS_YYYYMMDDHHMMSS.mp4）
+
+    Returns:
+        (start_time, end_time) 元组，如果解析失败返回 None
+    """
+    if not filename.endswith('.mp4'):
+        return None
+    parts = filename[:-4].split('_')
+    if len(parts) == 3:
+        start_str, end_str = parts[1], parts[2]
+    elif len(parts) == 2:
+        start_str, end_str = parts[0], parts[1]
+    else:
+        return None
+    if len(start_str) != 14 or len(end_str) != 14 or not (start_str + end_str).isdigit():
+        return None
+    try:
+        start_time = datetime(int(start_str[0:4]), int(start_str[4:6]), int(start_str[6:8]),
+                              int(start_str[8:10]), int(start_str[10:12]), int(start_str[12:14]))
+        end_time = datetime(int(end_str[0:4]), int(end_str[4:6]), int(end_str[6:8]),
+                            int(end_str[8:10]), int(end_str[10:12]), int(end_str[12:14]))
+    except ValueError:
+        return None
+    return start_time, end_time
+
+
+class SegmentIndex:
+    """单个摄像头目录的视频片段区间索引
+
+    按开始时间排序保存 starts/ends/names 三个数组，查询时用 bisect 二分定位。
+    刷新时只解析新出现的文件名，已删除的文件从索引中移除。
+    配置了片段目录（SegmentCatalog）时，创建索引时从目录恢复，刷新结果增量写回目录，
+    其他 worker 更新过的目录直接读取，不再访问 NAS。
+    """
+
+    def __init__(self, video_dir: str, max_age: float = 60.0, catalog=None):
+        self.video_dir = video_dir
+        self.max_age = max_age
+        self.catalog = catalog
+        # (starts, ends, names, meta) 快照，meta 为文件名 -> (size, mtime)
+        # 刷新时整体替换，查询无需加锁，也不会读到新的大小配旧的数组
+        self._snapshot: Tuple[List[datetime], List[datetime], List[str], Dict[str, Tuple[int, float]]] = \
+            ([], [], [], {})
+        self._known = set()
+        self._last_refresh = 0.0
+        self._refresh_lock = threading.Lock()
+        self._background_refresh = False
+        self.generation = 0
+        # 日期 -> (当天片段指纹, 覆盖信息)
+        self._coverage: 'OrderedDict[date, Tuple[Tuple, Dict]]' = OrderedDict()
+        self._coverage_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._snapshot[2])
+
+    @property
+    def age(self) -> float:
+        """距离上次刷新的秒数，从未刷新时为无穷大"""
+        if not self._last_refresh:
+            return float('inf')
+        return time.time() - self._last_refresh
+
+    def refresh(self, client) -> None:
+        """从 WebDAV 目录列表增量刷新索引
+
+        Args:
+            client: WebDAVClient 实例
+        """
+        started = time.time()
+        if self.catalog is not None:
+            # 以目录中最新的状态为基准计算增量
+            self._load_newer_catalog()
+        meta = {entry.name: (entry.size, entry.mtime)
+                for entry in client.iter_directory(self.video_dir)
+                if not entry.is_dir and entry.name.endswith('.mp4')}
+        old_meta = self._snapshot[3]
+        removed = self._known - meta.keys()
+        self._merge(meta)
+        if self.catalog is not None:
+            self._save_to_catalog(meta, old_meta, removed, started)
+        logger.info(f"Segment index refreshed for {self.video_dir}: "
+                    f"{len(self)} segments in {(time.time() - started) * 1000:.1f} ms")
+
+    def _save_to_catalog(self, meta: Dict[str, Tuple[int, float]], old_meta: Dict[str, Tuple[int, float]],
+                         removed, listed_at: float) -> None:
+        # 只写新增、大小或修改时间变化（正在录制）的片段和已删除的片段
+        upserts = []
+        for name, (size, mtime) in meta.items():
+            if old_meta.get(name) == (size, mtime):
+                continue
+            times = parse_segment_times(name)
+            if times is not None:
+                upserts.append((name, times[0], times[1], size, mtime))
+        try:
+            self.catalog.apply(self.video_dir, upserts, removed, listed_at)
+        except Exception as e:
+            logger.error(f"Failed to update segment catalog for {self.video_dir}: {e}")
+
+    def load_catalog(self) -> bool:
+        """从片段目录恢复索引，目录中没有该摄像头时返回 False"""
+        try:
+            listed_at, rows = self.catalog.load(self.video_dir)
+        except Exception as e:
+            logger.error(f"Failed to load segment catalog for {self.video_dir}: {e}")
+            return False
+        if not listed_at:
+            return False
+        meta = {row[2]: (row[3], row[4]) for row in rows}
+        self._snapshot = ([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows], meta)
+        self._known = set(meta)
+        self._last_refresh = listed_at
+        self.generation += 1
+        logger.info(f"Segment index for {self.video_dir} loaded from catalog: {len(rows)} segments, "
+                    f"listed {time.time() - listed_at:.0f}s ago")
+        return True
+
+    def _load_newer_catalog(self) -> bool:
+        """其他 worker 在本索引之后列过目录时重新加载"""
+        try:
+            listed_at = self.catalog.listed_at(self.video_dir)
+        except Exception as e:
+            logger.error(f"Failed to read segment catalog for {self.video_dir}: {e}")
+            return False
+        if listed_at <= self._last_refresh:
+            return False
+        return self.load_catalog()
+
+    def _merge(self, meta: Dict[str, Tuple[int, float]]) -> None:
+        """把最新的目录列表合并进索引
+
+        Args:
+            meta: 文件名 -> (size, mtime)
+        """
+        # 大小和修改时间每次整体替换（正在录制的片段会持续变大），不需要重新解析文件名
+        current = meta.keys()
+        new_names = current - self._known
+        removed = self._known - current
+        starts, ends, names, _ = self._snapshot
+
+        if not new_names and not removed:
+            self._snapshot = (starts, ends, names, meta)
+            self._last_refresh = time.time()
+            return
+
+        added = []
+        for name in new_names:
+            times = parse_segment_times(name)
+            if times is None:
+                logger.warning(f"Unsupported filename format: {name}")
+                continue
+            added.append((times[0], times[1], name))
+        added.sort()
+
+        if not removed and (not starts or not added or added[0][0] >= starts[-1]):
+            # 常见情况：只是在末尾追加了新录像
+            starts = starts + [entry[0] for entry in added]
+            ends = ends + [entry[1] for entry in added]
+            names = names + [entry[2] for entry in added]
+        else:
+            entries = [entry for entry in zip(starts, ends, names) if entry[2] not in removed]
+            entries.extend(added)
+            entries.sort()
+            starts = [entry[0] for entry in entries]
+            ends = [entry[1] for entry in entries]
+            names = [entry[2] for entry in entries]
+
+        # 解析失败的文件名也记入 _known，避免每次刷新重复解析
+        self._known = set(current)
+        self._snapshot = (starts, ends, names, meta)
+        self._last_refresh = time.time()
+        self.generation += 1
+
+    def ensure_fresh(self, client_factory: Callable, target_time: Optional[datetime] = None) -> None:
+        """在索引过期或目标时间超出索引末尾时刷新
+
+        Args:
+            client_factory: 返回 WebDAVClient 的可调用对象，只有需要刷新时才会调用
+            target_time: 本次查询的目标时间
+        """
+        if not self._needs_refresh(target_time):
+            return
+        with self._refresh_lock:
+            # 等待锁期间其他线程可能已经刷新过
+            if not self._needs_refresh(target_time):
+                return
+            if self.catalog is not None and self._load_newer_catalog() and not self._needs_refresh(target_time):
+                return
+            ends = self._snapshot[1]
+            if ends and (target_time is None or target_time <= ends[-1]):
+                # 只是过期、目标时间仍在索引范围内：先用现有索引回答，后台刷新
+                self._start_background_refresh(client_factory)
+                return
+            self.refresh(client_factory())
+
+    def _start_background_refresh(self, client_factory: Callable) -> None:
+        # 调用方持有 _refresh_lock
+        if self._background_refresh:
+            return
+        self._background_refresh = True
+
+        def run():
+            try:
+                with self._refresh_lock:
+                    if self.age > self.max_age:
+                        self.refresh(client_factory())
+            except Exception as e:
+                logger.error(f"Background refresh of segment index {self.video_dir} failed: {e}")
+            finally:
+                self._background_refresh = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _needs_refresh(self, target_time: Optional[datetime]) -> bool:
+        age = self.age
+        if age > self.max_age:
+            return True
+        if target_time is not None and age > MIN_REFRESH_INTERVAL:
+            ends = self._snapshot[1]
+            if not ends or target_time > ends[-1]:
+                return True
+        return False
+
+    def lookup(self, target_time: datetime) -> Optional[Dict]:
+        """查找包含目标时间的片段，找不到时返回最接近的片段
+
+        Args:
+            target_time: 目标时间 (datetime 对象)
+
+        Returns:
+            包含 filename/start_time/end_time/size/mtime/exact/time_diff 的字典，索引为空时返回 None
+        """
+        snapshot = self._snapshot
+        starts, ends, names, _ = snapshot
+        if not names:
+            return None
+
+        i = bisect.bisect_right(starts, target_time) - 1
+        # 检查开始时间不晚于目标的最后两个片段，兼容少量重叠的录像
+        for j in (i, i - 1):
+            if 0 <= j < len(names) and ends[j] >= target_time >= starts[j]:
+                return self._entry(j, True, 0.0, snapshot)
+
+        best = None
+        best_diff = float('inf')
+        for j in (i, i + 1):
+            if 0 <= j < len(names):
+                diff = min(abs((starts[j] - target_time).total_seconds()),
+                           abs((ends[j] - target_time).total_seconds()))
+                if diff < best_diff:
+                    best, best_diff = j, diff
+        return self._entry(best, False, best_diff, snapshot)
+
+    def following(self, start_time: datetime, limit: int, max_gap: Optional[float] = None) -> List[Dict]:
+        """返回从指定开始时间的片段起、按时间顺序的后续片段
+
+        Args:
+            start_time: 第一个片段的开始时间
+            limit: 最多返回的片段数
+            max_gap: 相邻片段之间允许的最大间隔（秒），遇到更长的录像缺口时停止，None 表示不检查
+
+        Returns:
+            片段字典列表，格式同 lookup
+        """
+        snapshot = self._snapshot
+        starts, ends, _, _ = snapshot
+        i = bisect.bisect_left(starts, start_time)
+        stop = min(i + limit, len(starts))
+        for j in range(i + 1, stop):
+            if max_gap is not None and (starts[j] - ends[j - 1]).total_seconds() > max_gap:
+                stop = j
+                break
+        return [self._entry(j, True, 0.0, snapshot) for j in range(i, stop)]
+
+    def coverage(self, day: date) -> Dict:
+        """返回某一天的录像覆盖情况
+
+        结果按天缓存，当天的片段没有变化时（只比较片段数和首尾文件名）直接返回缓存，
+        新录像追加到今天不会让之前日期的缓存失效。
+
+        Args:
+            day: 日期
+
+        Returns:
+            包含以下字段的字典：
+            - segments: 当天涉及的片段数
+            - recorded_seconds: 有录像的总秒数
+            - intervals: 合并后的 [开始秒, 结束秒] 列表，秒数从当天零点算起
+            - bitmap: 每分钟一位的位图（1440 位，高位在前），base64 编码
+        """
+        starts, ends, names, _ = snapshot = self._snapshot
+        day_start = datetime(day.year, day.month, day.day)
+        day_end = day_start + timedelta(days=1)
+        i, j = self._overlap_range(snapshot, day_start, day_end)
+        fingerprint = (j - i, names[i] if i < j else None, names[j - 1] if i < j else None)
+
+        with self._coverage_lock:
+            cached = self._coverage.get(day)
+            if cached is not None and cached[0] == fingerprint:
+                self._coverage.move_to_end(day)
+                return cached[1]
+
+        intervals: List[List[int]] = []
+        for k in range(i, j):
+            if ends[k] <= day_start:
+                continue
+            lo = max(int((starts[k] - day_start).total_seconds()), 0)
+            hi = min(int((ends[k] - day_start).total_seconds()), 86400)
+            if hi < lo:
+                continue
+            if intervals and lo <= intervals[-1][1] + COVERAGE_MERGE_GAP:
+                intervals[-1][1] = max(intervals[-1][1], hi)
+            else:
+                intervals.append([lo, hi])
+
+        bitmap = bytearray(180)
+        for lo, hi in intervals:
+            # 结束在整分处的区间不占用下一分钟
+            last = (hi - 1) // 60 if hi > lo else lo // 60
+            for minute in range(lo // 60, min(last, 1439) + 1):
+                bitmap[minute >> 3] |= 0x80 >> (minute & 7)
+
+        result = {
+            'segments': j - i,
+            'recorded_seconds': sum(hi - lo for lo, hi in intervals),
+            'intervals': intervals,
+            'bitmap': base64.b64encode(bytes(bitmap)).decode('ascii'),
+        }
+        with self._coverage_lock:
+            self._coverage[day] = (fingerprint, result)
+            self._coverage.move_to_end(day)
+            while len(self._coverage) > COVERAGE_CACHE_DAYS:
+                self._coverage.popitem(last=False)
+        return result
+
+    def between(self, start: datetime, end: datetime) -> List[Dict]:
+        """返回与 [start, end) 时间段有重叠的片段，按开始时间排序，格式同 lookup"""
+        snapshot = self._snapshot
+        i, j = self._overlap_range(snapshot, start, end)
+        return [self._entry(k, True, 0.0, snapshot) for k in range(i, j) if snapshot[1][k] > start]
+
+    @staticmethod
+    def _overlap_range(snapshot: Tuple, start: datetime, end: datetime) -> Tuple[int, int]:
+        # 开始时间落在 [start, end) 内的片段，再向前包含跨过 start 的片段
+        starts, ends, _, _ = snapshot
+        i = bisect.bisect_left(starts, start)
+        while i > 0 and ends[i - 1] > start:
+            i -= 1
+        return i, bisect.bisect_left(starts, end)
+
+    def _entry(self, i: int, exact: bool, time_diff: float, snapshot: Optional[Tuple] = None) -> Dict:
+        starts, ends, names, meta = snapshot or self._snapshot
+        size, mtime = meta.get(names[i], (0, 0.0))
+        return {
+            'filename': names[i],
+            'start_time': starts[i],
+            'end_time': ends[i],
+            'size': size,
+            'mtime': mtime,
+            'exact': exact,
+            'time_diff': time_diff,
+        }
+
+
+# 每个摄像头目录一个索引，跨请求复用
+_indexes: Dict[str, SegmentIndex] = {}
+_indexes_lock = threading.Lock()
+# 持久化的片段目录，由 use_segment_catalog 设置
+_catalog = None
+
+
+def use_segment_catalog(catalog) -> None:
+    """设置新建索引使用的片段目录，None 表示不持久化"""
+    global _catalog
+    _catalog = catalog
+
+
+def get_segment_index(video_dir: str, max_age: float = 60.0) -> SegmentIndex:
+    """获取（必要时创建）指定目录的片段索引"""
+    key = video_dir.rstrip('/')
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = SegmentIndex(key, max_age, _catalog)
+            if _catalog is not None:
+                index.load_catalog()
+            _indexes[key] = index
+        else:
+            index.max_age = max_age
+        return index
@@ -0,0 +1,416 @@
+import logging
+import os
+import select
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from .blocking import call_blocking
+
+logger = logging.getLogger(__name__)
+
+
+def _peer_closed(sock) -> bool:
+    """客户端是否已经关闭或重置连接；连接上只是暂时没有读取（播放器暂停）时返回 False"""
+    try:
+        readable, _, errored = select.select([sock], [], [sock], 0)
+        if errored:
+            return True
+        if not readable:
+            return False
+        # 可读但读不到数据说明对方已关闭；有数据（例如下一个请求）说明连接仍然可用，不取走数据
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+class StreamSession:
+    """一个观看者的推流会话"""
+
+    def __init__(self, client_id: str, video_dir: str, video_path: str,
+                 offset_seconds: float = 0.0, profile: str = ''):
+        # 服务端生成的流 ID，通过 X-Stream-Id 响应头返回给客户端
+        self.stream_id = uuid.uuid4().hex
+        self.client_id = client_id
+        self.video_dir = video_dir
+        self.video_path = video_path
+        self.offset_seconds = offset_seconds
+        self.profile = profile
+        self.broadcast = None
+        self.sub_id: Optional[int] = None
+        self.worker_pid = os.getpid()
+        self.started_at = time.time()
+        self.last_write_at = self.started_at
+        self.bytes_sent = 0
+        self.chunks_sent = 0
+        self.stop_requested = False
+        self.stop_reason: Optional[str] = None
+        # 客户端连接的 socket（服务器提供时），用于区分客户端已断开和播放器暂停
+        self.connection = None
+
+    def connection_closed(self) -> Optional[bool]:
+        """客户端连接是否已断开，无法判断时返回 None"""
+        if self.connection is None:
+            return None
+        return _peer_closed(self.connection)
+
+    def record_write(self, size: int) -> None:
+        """记录一次成功交给客户端连接的写入"""
+        self.bytes_sent += size
+        self.chunks_sent += 1
+        self.last_write_at = time.time()
+
+    @property
+    def idle_seconds(self) -> float:
+        return time.time() - self.last_write_at
+
+    @property
+    def viewers(self) -> int:
+        broadcast = self.broadcast
+        return broadcast.subscriber_count if broadcast is not None else 0
+
+    @property
+    def ffmpeg_pid(self) -> Optional[int]:
+        broadcast = self.broadcast
+        process = broadcast.process if broadcast is not None else None
+        return process.pid if process is not None else None
+
+    def to_dict(self) -> Dict:
+        return _describe({
+            'stream_id': self.stream_id,
+            'client_id': self.client_id,
+            'worker_pid': self.worker_pid,
+            'video_dir': self.video_dir,
+            'video_path': self.video_path,
+            'offset_seconds': self.offset_seconds,
+            'profile': self.profile,
+            'started_at': self.started_at,
+            'last_write_at': self.last_write_at,
+            'bytes_sent': self.bytes_sent,
+            'chunks_sent': self.chunks_sent,
+            'stop_requested': self.stop_requested,
+            'stop_reason': self.stop_reason,
+            'viewers': self.viewers,
+            'ffmpeg_pid': self.ffmpeg_pid,
+        })
+
+
+def _describe(row: Dict) -> Dict:
+    # 补充由时间戳计算的字段
+    now = time.time()
+    elapsed = max(now - row['started_at'], 1e-6)
+    row['duration_seconds'] = round(elapsed, 1)
+    row['throughput_bps'] = round(row['bytes_sent'] * 8 / elapsed)
+    row['idle_seconds'] = round(now - row['last_write_at'], 1)
+    row['stop_requested'] = bool(row['stop_requested'])
+    return row
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedStreamTable:
+    """多个 gunicorn worker 共享的推流表（SQLite 文件）
+
+    每个 worker 把自己的会话和进度写入同一个数据库文件；停止请求可能落在任意 worker 上，
+    对不属于本 worker 的会话只在表中设置停止标志，由会话所在的 worker 同步时执行停止。
+    worker 退出后残留的记录按进程号清理。
+    """
+
+    COLUMNS = ('stream_id', 'worker_pid', 'client_id', 'video_dir', 'video_path', 'offset_seconds', 'profile',
+               'ffmpeg_pid', 'viewers', 'started_at', 'last_write_at', 'bytes_sent', 'chunks_sent',
+               'stop_requested', 'stop_reason')
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 所有操作都很短，用一个连接加锁即可；autocommit，每条语句单独提交
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS streams (
+                    stream_id TEXT PRIMARY KEY,
+                    worker_pid INTEGER NOT NULL,
+                    client_id TEXT,
+                    video_dir TEXT,
+                    video_path TEXT,
+                    offset_seconds REAL,
+                    profile TEXT,
+                    ffmpeg_pid INTEGER,
+                    viewers INTEGER DEFAULT 0,
+                    started_at REAL,
+                    last_write_at REAL,
+                    bytes_sent INTEGER DEFAULT 0,
+                    chunks_sent INTEGER DEFAULT 0,
+                    stop_requested INTEGER DEFAULT 0,
+                    stop_reason TEXT
+                )''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS streams_client ON streams (client_id)')
+            # 进程号可能被复用，本 worker 启动时清掉同号进程留下的记录
+            self._conn.execute('DELETE FROM streams WHERE worker_pid = ?', (os.getpid(),))
+
+    def _run(self, fn):
+        """持有锁执行数据库操作 fn(conn)，gevent worker 中在原生线程里执行"""
+        with self._lock:
+            return call_blocking(fn, self._conn)
+
+    def _execute(self, sql: str, params=()) -> int:
+        """执行一条语句，返回影响的行数"""
+        return self._run(lambda conn: conn.execute(sql, params).rowcount)
+
+    def _query(self, sql: str, params=()) -> List[sqlite3.Row]:
+        return self._run(lambda conn: conn.execute(sql, params).fetchall())
+
+    def upsert(self, session: StreamSession) -> None:
+        row = session.to_dict()
+        values = [row[column] if column != 'stop_requested' else int(row[column]) for column in self.COLUMNS]
+        self._execute(f"INSERT OR REPLACE INTO streams ({', '.join(self.COLUMNS)}) "
+                      f"VALUES ({', '.join('?' * len(self.COLUMNS))})", values)
+
+    def heartbeat(self, sessions: List[StreamSession]) -> None:
+        """写回本 worker 会话的进度"""
+        rows = [(s.ffmpeg_pid, s.viewers, s.last_write_at, s.bytes_sent, s.chunks_sent, s.stream_id)
+                for s in sessions]
+        if not rows:
+            return
+
+        def update(conn):
+            conn.execute('BEGIN')
+            try:
+                conn.executemany('UPDATE streams SET ffmpeg_pid = ?, viewers = ?, last_write_at = ?, '
+                                 'bytes_sent = ?, chunks_sent = ? WHERE stream_id = ?', rows)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        self._run(update)
+
+    def remove(self, stream_id: str) -> None:
+        self._execute('DELETE FROM streams WHERE stream_id = ?', (stream_id,))
+
+    def request_stop(self, stream_id: Optional[str] = None, client_id: Optional[str] = None,
+                     stop_all: bool = False, reason: str = 'stop') -> List[str]:
+        """为匹配的会话设置停止标志，返回这些会话的流 ID"""
+        if stop_all:
+            where, params = '1 = 1', ()
+        elif stream_id:
+            where, params = 'stream_id = ?', (stream_id,)
+        elif client_id:
+            where, params = 'client_id = ?', (client_id,)
+        else:
+            return []
+
+        def mark(conn):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                ids = [row[0] for row in conn.execute(
+                    f'SELECT stream_id FROM streams WHERE {where} AND stop_requested = 0', params)]
+                conn.execute(f'UPDATE streams SET stop_requested = 1, stop_reason = ? '
+                             f'WHERE {where} AND stop_requested = 0', (reason, *params))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            return ids
+        return self._run(mark)
+
+    def pending_stops(self, worker_pid: int) -> List[sqlite3.Row]:
+        """其他 worker 为本 worker 的会话设置的停止请求"""
+        return self._query('SELECT stream_id, stop_reason FROM streams '
+                           'WHERE worker_pid = ? AND stop_requested = 1', (worker_pid,))
+
+    def list(self) -> List[Dict]:
+        rows = self._query('SELECT * FROM streams ORDER BY started_at')
+        return [_describe(dict(row)) for row in rows]
+
+    def prune(self) -> int:
+        """删除已退出 worker 留下的记录"""
+        pids = [row[0] for row in self._query('SELECT DISTINCT worker_pid FROM streams')]
+        removed = 0
+        for pid in pids:
+            if not _pid_alive(pid):
+                removed += self._execute('DELETE FROM streams WHERE worker_pid = ?', (pid,))
+        if removed:
+            logger.info(f"Pruned {removed} stream records left by exited workers")
+        return removed
+
+
+class StreamRegistry:
+    """活动推流会话的注册表
+
+    停止请求按流 ID 或客户端 ID 精确定位会话；后台线程停止长时间没有写出数据的会话
+    （客户端已经消失或停止读取），让最后一个观看者离开的 FFmpeg 及时退出。
+    配置了共享表时，会话同时登记到各 worker 共享的 SQLite 文件中，
+    停止请求和会话列表跨 worker 生效。
+    """
+
+    def __init__(self, shared: Optional[SharedStreamTable] = None):
+        self._sessions: Dict[str, StreamSession] = {}
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self.shared = shared
+        self.reaped = 0
+
+    def register(self, session: StreamSession) -> None:
+        with self._lock:
+            self._sessions[session.stream_id] = session
+        if self.shared:
+            self._shared_call('register', self.shared.upsert, session)
+
+    def unregister(self, stream_id: str) -> Optional[StreamSession]:
+        with self._lock:
+            session = self._sessions.pop(stream_id, None)
+        if self.shared:
+            self._shared_call('unregister', self.shared.remove, stream_id)
+        return session
+
+    def get(self, stream_id: str) -> Optional[StreamSession]:
+        with self._lock:
+            return self._sessions.get(stream_id)
+
+    def list(self) -> List[StreamSession]:
+        """本 worker 的会话"""
+        with self._lock:
+            return list(self._sessions.values())
+
+    def list_all(self) -> List[Dict]:
+        """所有 worker 的会话信息，没有共享表或共享表不可用时只返回本 worker 的会话"""
+        if self.shared:
+            rows = self._shared_call('list', self.shared.list)
+            if rows is not None:
+                # 本 worker 的会话用内存中的最新进度
+                local = {session.stream_id: session for session in self.list()}
+                return [local[row['stream_id']].to_dict() if row['stream_id'] in local else row for row in rows]
+        return [session.to_dict() for session in self.list()]
+
+    def find(self, stream_id: Optional[str] = None, client_id: Optional[str] = None) -> List[StreamSession]:
+        """在本 worker 中按流 ID 或客户端 ID 查找会话，两者都为空时返回空列表"""
+        with self._lock:
+            if stream_id:
+                session = self._sessions.get(stream_id)
+                return [session] if session else []
+            if client_id:
+                return [session for session in self._sessions.values() if session.client_id == client_id]
+            return []
+
+    def stop(self, session: StreamSession, reason: str = 'stop') -> None:
+        """停止本 worker 的会话：设置停止标志并离开广播，最后一个观看者离开时 FFmpeg 会被终止"""
+        if session.stop_requested:
+            return
+        session.stop_requested = True
+        session.stop_reason = reason
+        broadcast, sub_id = session.broadcast, session.sub_id
+        if broadcast is not None and sub_id is not None:
+            broadcast.unsubscribe(sub_id)
+        logger.info(f"Stopped stream {session.stream_id} ({reason})")
+
+    def request_stop(self, stream_id: Optional[str] = None, client_id: Optional[str] = None,
+                     stop_all: bool = False, reason: str = 'stop') -> List[str]:
+        """停止匹配的会话，返回流 ID
+
+        本 worker 的会话立即停止；其他 worker 的会话在共享表中设置停止标志，
+        由所在 worker 在下一次同步时停止。
+        """
+        local = self.list() if stop_all else self.find(stream_id, client_id)
+        stopped = []
+        for session in local:
+            self.stop(session, reason)
+            stopped.append(session.stream_id)
+        if self.shared:
+            remote = self._shared_call('request_stop', self.shared.request_stop,
+                                       stream_id, client_id, stop_all, reason) or []
+            stopped.extend(sid for sid in remote if sid not in stopped)
+        return stopped
+
+    def start(self, idle_timeout: float, reap_interval: float = 10.0, sync_interval: float = 1.0,
+              paused_timeout: float = 0.0) -> None:
+        """启动后台线程（只启动一次）：清理空闲会话，并与共享表同步进度和停止请求
+
+        Args:
+            idle_timeout: 超过该秒数没有写出数据、并且客户端连接已断开（或无法判断）的会话会被停止，0 表示不清理
+            reap_interval: 空闲检查间隔（秒）
+            sync_interval: 与共享表同步的间隔（秒）
+            paused_timeout: 连接仍然正常、只是不读取数据（播放器暂停）的会话超过该秒数才停止，0 表示不停止
+        """
+        if idle_timeout <= 0 and not self.shared:
+            return
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._run,
+                                            args=(idle_timeout, reap_interval, sync_interval, paused_timeout),
+                                            daemon=True)
+            self._worker.start()
+
+    def _run(self, idle_timeout: float, reap_interval: float, sync_interval: float, paused_timeout: float) -> None:
+        interval = min(reap_interval, sync_interval) if self.shared else reap_interval
+        last_reap = last_prune = time.time()
+        while True:
+            time.sleep(interval)
+            now = time.time()
+            try:
+                if self.shared:
+                    self.sync()
+                    if now - last_prune >= 60:
+                        last_prune = now
+                        self.shared.prune()
+                if idle_timeout > 0 and now - last_reap >= reap_interval:
+                    last_reap = now
+                    self.reap(idle_timeout, paused_timeout)
+            except Exception as e:
+                logger.error(f"Stream registry maintenance error: {e}")
+
+    def sync(self) -> None:
+        """执行其他 worker 提交的停止请求，并写回本 worker 会话的进度"""
+        for row in self.shared.pending_stops(os.getpid()):
+            session = self.get(row['stream_id'])
+            if session is not None:
+                self.stop(session, row['stop_reason'] or 'stop')
+        self.shared.heartbeat(self.list())
+
+    def reap(self, idle_timeout: float, paused_timeout: float = 0.0) -> int:
+        """停止空闲超时的会话，返回本次停止的数量
+
+        写出阻塞既可能是客户端已经不在，也可能是播放器暂停后不再读取。超过 idle_timeout 时先检查连接：
+        已断开或无法判断时停止；连接正常时认为是暂停，超过 paused_timeout（大于 0 时）才停止。
+        """
+        count = 0
+        for session in self.list():
+            if session.stop_requested or session.idle_seconds <= idle_timeout:
+                continue
+            if session.connection_closed() is False:
+                if paused_timeout <= 0 or session.idle_seconds <= paused_timeout:
+                    continue
+                reason = 'paused'
+            else:
+                reason = 'idle'
+            logger.warning(f"Reaping {reason} stream {session.stream_id}: no data written for "
+                           f"{session.idle_seconds:.0f}s, {session.bytes_sent} bytes sent")
+            self.stop(session, reason)
+            count += 1
+        self.reaped += count
+        return count
+
+    def _shared_call(self, action: str, fn, *args):
+        # 共享表出错时退化为只在本 worker 内生效，不影响推流
+        try:
+            return fn(*args)
+        except Exception as e:
+            logger.error(f"Shared stream table {action} failed: {e}")
+            return None
@@ -0,0 +1,299 @@
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from .scheduler import PRIORITY_BACKGROUND, TranscodeScheduler
+
+logger = logging.getLogger(__name__)
+
+# 缓存布局版本，写入雪碧图键；旧版本的片段缩略图没有按摄像头分目录，可能拼进了别的摄像头的画面
+CACHE_LAYOUT_VERSION = 2
+
+
+def extract_segment_thumbnails(url: str, out_dir: str, first_offset: float, count: int,
+                               interval: int, width: int, height: int, timeout: float = 300) -> int:
+    """抽取一个片段在固定时间点上的关键帧缩略图（在进程池中运行）
+
+    只解码关键帧，fps 滤镜从 first_offset 开始每 interval 秒取一帧（取该时间点之前最近的关键帧），
+    输出为 out_dir/0001.jpg、0002.jpg ...，全部完成后才把临时目录改名为 out_dir。
+
+    Args:
+        url: 片段地址
+        out_dir: 输出目录
+        first_offset: 第一个时间点在片段内的偏移（秒）
+        count: 时间点个数
+        interval: 时间点间隔（秒）
+        width: 缩略图宽度
+        height: 缩略图高度
+        timeout: FFmpeg 超时时间（秒）
+
+    Returns:
+        实际生成的缩略图数量
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(out_dir))
+    cmd = [
+        'ffmpeg', '-v', 'error',
+        '-skip_frame', 'nokey',
+        '-i', url,
+        '-vf', (f'fps=fps=1/{interval}:start_time={first_offset:.3f}:round=down:eof_action=pass,'
+                f'scale={width}:{height}:force_original_aspect_ratio=decrease,'
+                f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2'),
+        '-frames:v', str(count),
+        '-q:v', '5',
+        os.path.join(tmp_dir, '%04d.jpg')
+    ]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip()[-500:])
+        generated = len(os.listdir(tmp_dir))
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            # 其他进程已经生成过同一个片段
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return generated
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def build_sprite(tiles: List[str], columns: int, rows: int, out_path: str, timeout: float = 120) -> None:
+    """用 FFmpeg tile 滤镜把缩略图按顺序拼成一张雪碧图（在进程池中运行）
+
+    Args:
+        tiles: 按格子顺序排列的图片路径，没有录像的格子传入空白图
+        columns: 列数
+        rows: 行数
+        out_path: 输出 JPEG 路径
+        timeout: FFmpeg 超时时间（秒）
+    """
+    seq_dir = tempfile.mkdtemp(prefix='.seq_', dir=os.path.dirname(out_path))
+    tmp_path = out_path + '.part.jpg'
+    try:
+        for i, tile in enumerate(tiles, 1):
+            os.symlink(os.path.abspath(tile), os.path.join(seq_dir, f'{i:05d}.jpg'))
+        cmd = [
+            'ffmpeg', '-v', 'error',
+            '-framerate', '1',
+            '-i', os.path.join(seq_dir, '%05d.jpg'),
+            '-vf', f'tile={columns}x{rows}',
+            '-frames:v', '1',
+            '-q:v', '5',
+            '-y', tmp_path
+        ]
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip()[-500:])
+        os.replace(tmp_path, out_path)
+    finally:
+        shutil.rmtree(seq_dir, ignore_errors=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _create_blank(path: str, width: int, height: int) -> None:
+    if os.path.exists(path):
+        return
+    tmp_path = path + '.part.jpg'
+    subprocess.run([
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i', f'color=c=black:s={width}x{height}',
+        '-frames:v', '1', '-y', tmp_path
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, timeout=30)
+    os.replace(tmp_path, path)
+
+
+class ThumbnailStore:
+    """按小时生成时间轴缩略图雪碧图，并持久化缓存
+
+    每个片段按墙钟时间对齐，每 interval 秒取一张关键帧缩略图，结果按片段文件名缓存；
+    每小时的雪碧图和 JSON 索引按该小时涉及的片段文件名列表缓存，新片段到来时只补抽新片段。
+    抽帧和拼图都在有界进程池中执行，Web 请求不会等待生成。
+    """
+
+    def __init__(self, cache_dir: str, url_for: Callable[[Dict], str], interval: int = 30,
+                 width: int = 160, height: int = 90, columns: int = 10, workers: int = 2,
+                 scheduler: Optional[TranscodeScheduler] = None):
+        """
+        Args:
+            cache_dir: 缓存目录
+            url_for: url_for(segment) 返回片段的读取地址
+            interval: 缩略图时间间隔（秒），应能整除 3600
+            width: 缩略图宽度
+            height: 缩略图高度
+            columns: 雪碧图列数
+            workers: 进程池大小
+            scheduler: FFmpeg 准入控制，抽帧以后台优先级申请名额，给交互播放让路
+        """
+        self.cache_dir = cache_dir
+        self.interval = interval
+        self.width = width
+        self.height = height
+        self.columns = columns
+        self.slots = 3600 // interval
+        self.rows = math.ceil(self.slots / columns)
+        self._url_for = url_for
+        self._workers = workers
+        self._transcode_scheduler = scheduler
+        self._profile = f"{interval}s_{width}x{height}"
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # 每小时一个调度任务，在线程中等待进程池里的抽帧和拼图
+        self._builder = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnails')
+        self._jobs: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.segment_dir = os.path.join(cache_dir, self._profile, 'segments')
+        self.sprite_dir = os.path.join(cache_dir, self._profile, 'sprites')
+        os.makedirs(self.segment_dir, exist_ok=True)
+        os.makedirs(self.sprite_dir, exist_ok=True)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # spawn 避免在多线程的 Web 进程中 fork
+                self._pool = ProcessPoolExecutor(max_workers=self._workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def sprite_key(self, video_dir: str, hour_start: datetime, segments: List[Dict]) -> str:
+        """雪碧图缓存键，由目录、小时和片段文件名列表决定"""
+        raw = '|'.join([f"v{CACHE_LAYOUT_VERSION}", video_dir, hour_start.strftime('%Y%m%d%H'), self._profile] +
+                       [segment['filename'] for segment in segments])
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def sprite_path(self, key: str) -> str:
+        return os.path.join(self.sprite_dir, f"{key}.jpg")
+
+    def hour_index(self, video_dir: str, hour_start: datetime, segments: List[Dict]) -> Dict:
+        """返回某小时的雪碧图索引，尚未生成时在后台开始生成
+
+        Args:
+            video_dir: 摄像头目录
+            hour_start: 整点时间
+            segments: 与该小时有重叠的片段（SegmentIndex.between 的结果）
+
+        Returns:
+            status 为 'ready' 时包含 key/tiles 等字段，'pending' 表示正在生成，'empty' 表示没有录像
+        """
+        if not segments:
+            return {'status': 'empty'}
+        key = self.sprite_key(video_dir, hour_start, segments)
+        index_path = os.path.join(self.sprite_dir, f"{key}.json")
+        try:
+            with open(index_path, 'r', encoding='utf-8') as file:
+                return {'status': 'ready', **json.load(file)}
+        except (OSError, ValueError):
+            pass
+
+        with self._lock:
+            created = key not in self._jobs
+            if created:
+                self._jobs[key] = self._builder.submit(self._build_hour, key, video_dir, hour_start, segments)
+            job = self._jobs[key]
+        if created:
+            job.add_done_callback(lambda done: self._finish(key, done))
+        return {'status': 'pending'}
+
+    def _finish(self, key: str, job: Future) -> None:
+        # 失败的任务不保留，下次请求时重试
+        with self._lock:
+            self._jobs.pop(key, None)
+        if job.exception() is not None:
+            logger.error(f"Thumbnail sprite build failed for {key}: {job.exception()}")
+
+    def _segment_slots(self, segment: Dict, hour_start: datetime):
+        """片段在该小时内覆盖的格子：(第一个格子序号, 片段内第一个时间点偏移, 格子数)"""
+        hour_end = hour_start + timedelta(hours=1)
+        start = max(segment['start_time'], hour_start)
+        end = min(segment['end_time'], hour_end)
+        first_slot = math.ceil((start - hour_start).total_seconds() / self.interval)
+        first_time = hour_start + timedelta(seconds=first_slot * self.interval)
+        if first_time >= end:
+            return first_slot, 0.0, 0
+        count = math.ceil((end - first_time).total_seconds() / self.interval)
+        offset = (first_time - segment['start_time']).total_seconds()
+        return first_slot, offset, min(count, self.slots - first_slot)
+
+    def _submit(self, camera: str, fn, *args) -> Future:
+        """申请后台名额后提交到进程池，任务结束时归还名额"""
+        pool = self._get_pool()
+        scheduler = self._transcode_scheduler
+        if scheduler is None:
+            return pool.submit(fn, *args)
+        ticket = scheduler.request(camera, 'thumbnails', PRIORITY_BACKGROUND)
+        scheduler.wait(ticket)
+        try:
+            future = pool.submit(fn, *args)
+        except Exception:
+            scheduler.release(ticket)
+            raise
+        future.add_done_callback(lambda _: scheduler.release(ticket))
+        return future
+
+    def _build_hour(self, key: str, video_dir: str, hour_start: datetime, segments: List[Dict]) -> None:
+        tiles: List[Optional[str]] = [None] * self.slots
+        pending = []
+        camera_dir = hashlib.sha1(video_dir.encode('utf-8')).hexdigest()[:16]
+        os.makedirs(os.path.join(self.segment_dir, camera_dir), exist_ok=True)
+        for segment in segments:
+            first_slot, offset, count = self._segment_slots(segment, hour_start)
+            if count <= 0:
+                continue
+            # 跨小时的片段在每个小时内各自抽取，按片段文件名和小时区分；
+            # 各摄像头的片段文件名都是时间戳，会互相重名，所以先按摄像头目录分开
+            stem = segment['filename'].rsplit('.', 1)[0]
+            out_dir = os.path.join(self.segment_dir, camera_dir, f"{stem}_{hour_start:%H}")
+            if not os.path.isdir(out_dir):
+                future = self._submit(video_dir, extract_segment_thumbnails, self._url_for(segment), out_dir,
+                                     offset, count, self.interval, self.width, self.height)
+                pending.append((segment['filename'], future))
+            for i in range(count):
+                tiles[first_slot + i] = os.path.join(out_dir, f"{i + 1:04d}.jpg")
+
+        for filename, future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"Thumbnail extraction failed for {filename}: {e}")
+
+        blank = os.path.join(self.cache_dir, self._profile, 'blank.jpg')
+        _create_blank(blank, self.width, self.height)
+        available = []
+        for slot, tile in enumerate(tiles):
+            if tile is not None and os.path.exists(tile):
+                available.append(slot)
+            else:
+                tiles[slot] = blank
+        tiles.extend([blank] * (self.rows * self.columns - self.slots))
+        self._get_pool().submit(build_sprite, tiles, self.columns, self.rows, self.sprite_path(key)).result()
+
+        index = {
+            'key': key,
+            'hour_start': hour_start.strftime('%Y-%m-%d %H:%M:%S'),
+            'interval': self.interval,
+            'width': self.width,
+            'height': self.height,
+            'columns': self.columns,
+            'rows': self.rows,
+            'tiles': [{
+                'time': (hour_start + timedelta(seconds=slot * self.interval)).strftime('%Y-%m-%d %H:%M:%S'),
+                'x': slot % self.columns * self.width,
+                'y': slot // self.columns * self.height,
+            } for slot in available],
+        }
+        index_path = os.path.join(self.sprite_dir, f"{key}.json")
+        with open(index_path + '.part', 'w', encoding='utf-8') as file:
+            json.dump(index, file)
+        os.replace(index_path + '.part', index_path)
+        logger.info(f"Built thumbnail sprite for {hour_start:%Y-%m-%d %H}:00 "
+                    f"({len(available)}/{self.slots} tiles, {len(pending)} segments extracted)")
@@ -1,24 +1,111 @@
+import calendar
 import requests
 from webdav3.client import Client
 import os
-from typing import List, Dict, Optional
+import threading
+import time
+from typing import Iterator, List, Dict, NamedTuple, Optional
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, unquote, urlsplit
 import logging
 from urllib3.exceptions import HTTPError
-from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
 import xml.etree.ElementTree as ET
 
+from .metrics import PROPFIND_ENTRIES, PROPFIND_ERRORS, PROPFIND_SECONDS, RANGE_READ_BYTES, RANGE_READ_SECONDS
+
 # 配置日志
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# WebDAV 服务器配置，可通过环境变量覆盖
+WEBDAV_SERVER = os.getenv('WEBDAV_SERVER', 'https://home.kyxw007.wang:5008')
+WEBDAV_USERNAME = os.getenv('WEBDAV_USERNAME', 'kyxw007')
+WEBDAV_PASSWORD = os.getenv('WEBDAV_PASSWORD', 'nb061617')
+# 连接池大小，决定同时保持的 keep-alive 连接数
+WEBDAV_POOL_SIZE = int(os.getenv('WEBDAV_POOL_SIZE', '16'))
+# 连接和读取超时（秒），NAS 卡住时请求失败而不是一直占住索引刷新锁或块缓存下载
+WEBDAV_CONNECT_TIMEOUT = float(os.getenv('WEBDAV_CONNECT_TIMEOUT', '10'))
+WEBDAV_TIMEOUT = float(os.getenv('WEBDAV_TIMEOUT', '30'))
+# 流式下载时每次产出的字节数
+STREAM_CHUNK_SIZE = int(os.getenv('WEBDAV_STREAM_CHUNK_SIZE', str(256 * 1024)))
+
+# PROPFIND 请求体，只取需要的属性
+PROPFIND_BODY = '''<?xml version="1.0" encoding="utf-8" ?>
+<propfind xmlns="DAV:">
+    <prop>
+        <resourcetype/>
+        <getcontentlength/>
+        <getlastmodified/>
+    </prop>
+</propfind>'''
+
+# 预先拼好的 DAV 命名空间标签，避免解析时反复查找
+DAV_RESPONSE = '{DAV:}response'
+DAV_HREF = '{DAV:}href'
+DAV_COLLECTION = '{DAV:}collection'
+DAV_CONTENT_LENGTH = '{DAV:}getcontentlength'
+DAV_LAST_MODIFIED = '{DAV:}getlastmodified'
+
+_MONTHS = {name: i for i, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+def parse_http_date(text: Optional[str]) -> float:
+    """解析 getlastmodified 中的 HTTP 日期，返回 Unix 时间戳，失败返回 0
+
+    绝大多数服务器使用固定格式 'Sun, 01 Jun 2025 10:00:00 GMT'，直接按位置切片解析，
+    其他格式退回到 email.utils 的通用解析。
+    """
+    if not text:
+        return 0.0
+    try:
+        if len(text) == 29 and text.endswith(' GMT'):
+            return float(calendar.timegm((
+                int(text[12:16]), _MONTHS[text[8:11]], int(text[5:7]),
+                int(text[17:19]), int(text[20:22]), int(text[23:25]), 0, 0, 0
+            )))
+        return parsedate_to_datetime(text).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+class DavEntry(NamedTuple):
+    """PROPFIND 返回的单个条目"""
+    name: str
+    path: str
+    size: int
+    mtime: float
+    is_dir: bool
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """没有显式指定 timeout 的请求使用默认的 (连接, 读取) 超时"""
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+
 class WebDAVClient:
-    def __init__(self, username="kyxw007", password="nb061617"):
-        self.server_url = "https://home.kyxw007.wang:5008"
+    def __init__(self, username="kyxw007", password="nb061617", server_url=None, pool_size=WEBDAV_POOL_SIZE):
+        self.server_url = server_url or WEBDAV_SERVER
         self.auth = (username, password)
         self.verify_ssl = False  # 忽略SSL证书验证
         self.client = None
+        self.session = self._create_session(pool_size)
         self._connect()
 
+    def _create_session(self, pool_size: int) -> requests.Session:
+        """创建带连接池的 requests 会话，复用 TCP/TLS 连接"""
+        session = requests.Session()
+        session.auth = self.auth
+        session.verify = self.verify_ssl
+        adapter = TimeoutHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                     timeout=(WEBDAV_CONNECT_TIMEOUT, WEBDAV_TIMEOUT))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
     def _connect(self):
         """建立 WebDAV 连接"""
         if not self.auth[0] or not self.auth[1]:
@@ -26,7 +113,7 @@ class WebDAVClient:
 
         options = {
             'webdav_hostname': self.server_url,
-            'webdav_timeout': 30,
+            'webdav_timeout': WEBDAV_TIMEOUT,
             'webdav_login': self.auth[0],
             'webdav_password': self.auth[1],
             'webdav_root': '/',  # 设置根路径
@@ -40,22 +127,26 @@ class WebDAVClient:
             self.client = Client(options)
             # 测试连接
             logger.debug("Testing connection with PROPFIND request...")
-            response = self._propfind_request('/')
+            response = self._propfind_request('/', depth='0')
             logger.debug(f"Initial PROPFIND response: {response}")
             logger.info("Successfully connected to WebDAV server")
         except Exception as e:
             logger.error(f"Failed to connect to WebDAV server: {str(e)}")
             raise
 
-    def _propfind_request(self, path: str) -> List[str]:
+    def _iter_propfind(self, path: str, depth: str = '1') -> Iterator[DavEntry]:
         """
-        发送 PROPFIND 请求获取目录内容
+        发送 PROPFIND 请求，并以流式方式逐条解析响应
+        
+        响应体不会整体读入内存，每解析完一个 <D:response> 就释放对应的 XML 节点，
+        目录条目再多内存占用也保持在常数级别。
         
         Args:
             path: 要查询的路径
+            depth: PROPFIND 的 Depth 头，'0' 只查询自身，'1' 查询直接子项
             
         Returns:
-            目录内容列表
+            DavEntry 生成器
         """
         # 确保路径以斜杠开头
         if not path.startswith('/'):
@@ -65,48 +156,108 @@ class WebDAVClient:
         logger.debug(f"Sending PROPFIND request to: {url}")
         
         headers = {
-            'Depth': '1',
+            'Depth': depth,
             'Content-Type': 'application/xml'
         }
         
-        # PROPFIND 请求体
-        body = '''<?xml version="1.0" encoding="utf-8" ?>
-        <propfind xmlns="DAV:">
-            <prop>
-                <resourcetype/>
-                <getcontentlength/>
-                <getlastmodified/>
-            </prop>
-        </propfind>'''
-        
+        started = time.perf_counter()
+        entries = 0
         try:
-            response = requests.request('PROPFIND', url, auth=self.auth, headers=headers, data=body, verify=self.verify_ssl)
-            response.raise_for_status()
-            
-            # 解析 XML 响应
-            root = ET.fromstring(response.text)
-            items = []
-            
-            # 使用命名空间
-            ns = {'D': 'DAV:'}
-            
-            # 遍历所有响应
-            for response in root.findall('.//D:response', ns):
-                href = response.find('.//D:href', ns)
-                if href is not None:
-                    # 获取相对路径
-                    path = href.text
-                    if path.startswith(self.server_url):
-                        path = path[len(self.server_url):]
-                    if path.startswith('/'):
-                        path = path[1:]
-                    items.append(path)
-            
-            return items
+            with self.session.request('PROPFIND', url, headers=headers, data=PROPFIND_BODY, stream=True) as response:
+                response.raise_for_status()
+                # 让 urllib3 处理 gzip 等传输编码
+                response.raw.decode_content = True
+                
+                root = None
+                href = None
+                size = 0
+                mtime = 0.0
+                is_dir = False
+                for event, elem in ET.iterparse(response.raw, events=('start', 'end')):
+                    if event == 'start':
+                        if root is None:
+                            root = elem
+                        continue
+                    
+                    # 只在叶子节点结束时取值，不对每个 response 做子树查找
+                    tag = elem.tag
+                    if tag == DAV_HREF:
+                        href = elem.text
+                    elif tag == DAV_CONTENT_LENGTH:
+                        if elem.text and elem.text.isdigit():
+                            size = int(elem.text)
+                    elif tag == DAV_LAST_MODIFIED:
+                        mtime = parse_http_date(elem.text)
+                    elif tag == DAV_COLLECTION:
+                        is_dir = True
+                    elif tag == DAV_RESPONSE:
+                        entry = self._make_entry(href, size, mtime, is_dir)
+                        href, size, mtime, is_dir = None, 0, 0.0, False
+                        # 已处理的节点立即从根节点上摘掉，保持内存有界
+                        root.clear()
+                        if entry is not None:
+                            entries += 1
+                            yield entry
             
         except requests.exceptions.RequestException as e:
+            PROPFIND_ERRORS.inc()
             logger.error(f"PROPFIND request failed: {str(e)}")
             raise
+        
+        finally:
+            # 包含流式解析的时间；调用方提前结束迭代时也会记录
+            PROPFIND_SECONDS.observe(time.perf_counter() - started, depth=depth)
+            PROPFIND_ENTRIES.observe(entries, depth=depth)
+
+    @staticmethod
+    def _make_entry(href: Optional[str], size: int, mtime: float, is_dir: bool) -> Optional[DavEntry]:
+        """把单个 <D:response> 中取到的属性组装为 DavEntry"""
+        if not href:
+            return None
+        # href 可能是完整 URL，也可能是经过 URL 编码的绝对路径
+        if not href.startswith('/'):
+            href = urlsplit(href).path
+        path = unquote(href) if '%' in href else href
+        if path.endswith('/'):
+            is_dir = True
+        name = path.rstrip('/').rsplit('/', 1)[-1]
+        return DavEntry(name=name, path=path, size=size, mtime=mtime, is_dir=is_dir)
+
+    def _propfind_request(self, path: str, depth: str = '1') -> List[str]:
+        """
+        发送 PROPFIND 请求获取目录内容
+        
+        Args:
+            path: 要查询的路径
+            depth: PROPFIND 的 Depth 头
+            
+        Returns:
+            目录内容列表
+        """
+        return [entry.path.lstrip('/') for entry in self._iter_propfind(path, depth)]
+
+    def iter_directory(self, remote_path: str = "/") -> Iterator[DavEntry]:
+        """
+        流式遍历指定目录下的文件和文件夹（不包含目录自身）
+        
+        Args:
+            remote_path: 远程目录路径，默认为根目录
+            
+        Returns:
+            DavEntry 生成器，包含 name/path/size/mtime/is_dir
+        """
+        if not self.client:
+            raise ConnectionError("WebDAV client not initialized")
+        
+        # 确保路径以斜杠结尾
+        if not remote_path.endswith('/'):
+            remote_path = remote_path + '/'
+        self_path = unquote(remote_path).rstrip('/')
+        
+        for entry in self._iter_propfind(remote_path):
+            if entry.path.rstrip('/') == self_path:
+                continue
+            yield entry
 
     def list_directory(self, remote_path: str = "/") -> List[Dict]:
         """
@@ -120,56 +271,51 @@ class WebDAVClient:
             - name: 文件名
             - path: 完整路径
             - type: 类型（'directory' 或 'file'）
+            - size: 文件大小（字节）
+            - mtime: 最后修改时间（Unix 时间戳）
         """
-        if not self.client:
-            raise ConnectionError("WebDAV client not initialized")
-            
         try:
-            # 确保路径以斜杠结尾
-            if not remote_path.endswith('/'):
-                remote_path = remote_path + '/'
-                
             logger.debug(f"Listing directory: {remote_path}")
-            items = self._propfind_request(remote_path)
-            logger.debug(f"Raw items list from server: {items}")
+            result = [{
+                'name': entry.name,
+                'path': entry.path,
+                'type': 'directory' if entry.is_dir else 'file',
+                'size': entry.size,
+                'mtime': entry.mtime
+            } for entry in self.iter_directory(remote_path)]
             
-            if not items:
+            if not result:
                 logger.warning("Server returned empty list")
-                return []
-                
-            result = []
-            
-            for item_path in items:
-                try:
-                    # 移除路径开头的斜杠（如果存在）
-                    if item_path.startswith('/'):
-                        item_path = item_path[1:]
-                        
-                    full_path = os.path.join(remote_path, item_path).replace("\\", "/")
-                    logger.debug(f"Processing item: {full_path}")
-                    
-                    # 根据路径末尾是否有斜杠来判断是否为目录
-                    is_dir = item_path.endswith('/')
-                    
-                    result.append({
-                        'name': os.path.basename(item_path.rstrip('/')),
-                        'path': full_path,
-                        'type': 'directory' if is_dir else 'file'
-                    })
-                except Exception as e:
-                    logger.warning(f"Error processing {item_path}: {str(e)}")
-                    continue
-                
-            logger.debug(f"Final result list: {result}")
+            logger.debug(f"Listed {len(result)} items in {remote_path}")
             return result
             
         except Exception as e:
             logger.error(f"Failed to list directory: {str(e)}")
             raise
 
+    def stat_file(self, path: str) -> Optional[DavEntry]:
+        """查询单个文件的大小和修改时间
+        
+        Args:
+            path: 文件路径
+            
+        Returns:
+            DavEntry，文件不存在时返回 None
+        """
+        try:
+            for entry in self._iter_propfind(quote(path), depth='0'):
+                return entry
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+        return None
+
     def download_file(self, path: str):
         """下载文件内容
         
+        整个文件读入内存，只适合小文件；视频片段应使用 stream_file 边读边发送。
+        
         Args:
             path: 文件路径
             
@@ -177,51 +323,117 @@ class WebDAVClient:
             文件内容的二进制数据，如果下载失败返回None
         """
         try:
-            # 使用 requests 直接下载文件
-            response = requests.get(
-                f"{self.server_url}{path}",
-                auth=self.auth,
-                verify=self.verify_ssl  # 使用指定的SSL验证
-            )
-            
-            if response.status_code == 200:
-                return response.content
-            else:
-                logger.error(f"Error downloading file {path}: HTTP {response.status_code}")
-                return None
-                
+            return b''.join(self.stream_file(path))
         except Exception as e:
             logger.error(f"Error downloading file {path}: {str(e)}")
             return None
 
-    def stream_file(self, path):
-        """流式传输文件内容
+    def read_range(self, path: str, start: int, length: int) -> bytes:
+        """读取文件中的一段字节
         
         Args:
             path: 文件路径
+            start: 起始偏移
+            length: 读取长度
             
         Returns:
-            文件内容的生成器，用于流式传输
+            读取到的数据，服务器不支持 Range 时只返回前 length 字节
         """
-        try:
-            # 使用 requests 流式下载文件
-            with requests.get(
-                f"{self.server_url}{path}",
-                auth=self.auth,
-                verify=self.verify_ssl,  # 使用指定的SSL验证
-                stream=True    # 启用流式传输
-            ) as response:
-                if response.status_code == 200:
-                    # 使用生成器逐块返回数据
-                    for chunk in response.iter_content(chunk_size=8192):  # 8KB chunks
-                        if chunk:
-                            yield chunk
-                else:
-                    logger.error(f"Error streaming file {path}: HTTP {response.status_code}")
-                    
-        except Exception as e:
-            logger.error(f"Error streaming file {path}: {str(e)}")
-            yield None
+        headers = {'Range': f'bytes={start}-{start + length - 1}'}
+        with RANGE_READ_SECONDS.time():
+            with self.session.get(f"{self.server_url}{quote(path)}", headers=headers, stream=True) as response:
+                response.raise_for_status()
+                if response.status_code != 206 and start > 0:
+                    raise IOError(f"Server ignored Range request for {path}")
+                data = bytearray()
+                for chunk in response.iter_content(chunk_size=65536):
+                    data += chunk
+                    if len(data) >= length:
+                        break
+        RANGE_READ_BYTES.inc(min(len(data), length))
+        return bytes(data[:length])
+
+    def stream_file(self, path: str, start: int = 0, end: Optional[int] = None,
+                    size: Optional[int] = None, mtime: Optional[float] = None) -> Iterator[bytes]:
+        """流式读取文件 [start, end] 范围内的字节
+        
+        启用块缓存时按块从缓存产出，缺失的块并行下载并预读后续块；否则用一个 Range 请求只下载需要的字节，
+        每次产出 STREAM_CHUNK_SIZE 字节。读完请求的范围或生成器被关闭（例如客户端断开）时立即释放到 NAS 的连接。
+        
+        Args:
+            path: 文件路径
+            start: 起始偏移
+            end: 结束偏移（包含），None 表示到文件结尾
+            size: 已知的文件大小，和 mtime 一起提供时启用块缓存也不需要 PROPFIND
+            mtime: 已知的文件修改时间
+            
+        Returns:
+            字节块的生成器
+            
+        Raises:
+            FileNotFoundError: 文件不存在
+            IOError: 下载失败；已经产出部分数据后失败时同样抛出，调用方据此中断响应，而不是发送不完整的内容
+        """
+        cache = _block_cache
+        if cache is not None and cache.enabled:
+            if size is None or mtime is None:
+                entry = self.stat_file(path)
+                if entry is None:
+                    raise FileNotFoundError(path)
+                size, mtime = entry.size, entry.mtime
+            yield from cache.iter_range(path, size, mtime, start, size - 1 if end is None else end)
+            return
+        
+        headers = {}
+        if start > 0 or end is not None:
+            headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+        remaining = None if end is None else end - start + 1
+        with self.session.get(f"{self.server_url}{quote(path)}", headers=headers, stream=True) as response:
+            if response.status_code == 404:
+                raise FileNotFoundError(path)
+            response.raise_for_status()
+            if response.status_code != 206 and start > 0:
+                raise IOError(f"Server ignored Range request for {path}")
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if remaining is not None:
+                    # 服务器忽略 Range 返回整个文件时，读够就停止
+                    chunk = chunk[:remaining]
+                    remaining -= len(chunk)
+                if chunk:
+                    yield chunk
+                if remaining == 0:
+                    break
+
+# 进程内共享的客户端实例
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+# 文件下载使用的块缓存（BlockCache），None 表示直接请求 WebDAV
+_block_cache = None
+
+def use_block_cache(cache) -> None:
+    """设置 download_file/stream_file 使用的块缓存"""
+    global _block_cache
+    _block_cache = cache
+
+def get_client() -> WebDAVClient:
+    """获取进程内共享的 WebDAV 客户端
+
+    第一次调用时创建客户端并做一次连接探测，之后所有请求复用同一个连接池。
+    探测失败时不缓存，下次调用会重新尝试。
+    """
+    global _shared_client
+    if _shared_client is not None:
+        return _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = WebDAVClient(
+                username=WEBDAV_USERNAME,
+                password=WEBDAV_PASSWORD,
+                server_url=WEBDAV_SERVER,
+                pool_size=WEBDAV_POOL_SIZE
+            )
+        return _shared_client
 
 # 使用示例
 if __name__ == "__main__":
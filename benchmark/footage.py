@@ -0,0 +1,115 @@
+"""用 FFmpeg 的 lavfi 源生成小米摄像头风格的合成录像
+
+先编码少量模板片段，再按录像文件名规则用符号链接铺满目录，几万个片段的目录也能在几秒内生成。
+两种文件名格式都会生成：
+    00_YYYYMMDDHHMMSS_YYYYMMDDHHMMSS.mp4（prefixed）
+    YYYYMMDDHHMMSS_YYYYMMDDHHMMSS.mp4（plain）
+
+    python -m benchmark.footage /tmp/footage --segments 1000 --segment-seconds 60
+"""
+import argparse
+import os
+import subprocess
+from datetime import datetime, timedelta
+from typing import List
+
+FILENAME_FORMATS = ('prefixed', 'plain')
+# 合成录像的起始时间
+DEFAULT_START = datetime(2025, 6, 1, 0, 0, 0)
+
+
+def segment_name(start: datetime, end: datetime, filename_format: str) -> str:
+    """按录像文件名规则生成片段文件名"""
+    name = f"{start:%Y%m%d%H%M%S}_{end:%Y%m%d%H%M%S}.mp4"
+    return f"00_{name}" if filename_format == 'prefixed' else name
+
+
+def encode_template(path: str, seconds: int, width: int = 1280, height: int = 720, fps: int = 20,
+                    variant: int = 0, ffmpeg: str = 'ffmpeg') -> None:
+    """编码一个模板片段：testsrc2 画面 + 正弦波音频，H.264/AAC，和摄像头录像一样每 2 秒一个关键帧"""
+    if os.path.exists(path):
+        return
+    temp_path = f"{path}.tmp.mp4"
+    cmd = [
+        ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={fps}',
+        '-f', 'lavfi', '-i', f'sine=frequency={440 + 110 * variant}:sample_rate=16000',
+        '-t', str(seconds),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-g', str(fps * 2),
+        '-c:a', 'aac', '-b:a', '32k',
+        '-movflags', '+faststart',
+        temp_path
+    ]
+    subprocess.run(cmd, check=True)
+    os.replace(temp_path, path)
+
+
+def generate_templates(out_dir: str, count: int, seconds: int, width: int, height: int,
+                       ffmpeg: str = 'ffmpeg') -> List[str]:
+    """生成（或复用已有的）模板片段，返回路径列表"""
+    template_dir = os.path.join(out_dir, '.templates')
+    os.makedirs(template_dir, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(template_dir, f'template_{seconds}s_{width}x{height}_{i}.mp4')
+        encode_template(path, seconds, width, height, variant=i, ffmpeg=ffmpeg)
+        paths.append(path)
+    return paths
+
+
+def populate_camera(camera_dir: str, templates: List[str], segments: int, seconds: int,
+                    filename_format: str = 'prefixed', start: datetime = DEFAULT_START,
+                    gap_every: int = 0) -> List[str]:
+    """在摄像头目录中铺满连续的片段（模板的符号链接）
+
+    Args:
+        camera_dir: 摄像头目录
+        templates: 模板片段路径
+        segments: 片段数量
+        seconds: 每个片段的时长（秒）
+        filename_format: 'prefixed' 或 'plain'
+        start: 第一个片段的开始时间
+        gap_every: 每隔多少个片段跳过一个，模拟录像中断，0 表示不中断
+
+    Returns:
+        生成的文件名列表
+    """
+    if filename_format not in FILENAME_FORMATS:
+        raise ValueError(f"Unknown filename format: {filename_format}")
+    os.makedirs(camera_dir, exist_ok=True)
+    existing = set(os.listdir(camera_dir))
+    names = []
+    for i in range(segments):
+        if gap_every and i % gap_every == gap_every - 1:
+            continue
+        segment_start = start + timedelta(seconds=i * seconds)
+        name = segment_name(segment_start, segment_start + timedelta(seconds=seconds), filename_format)
+        names.append(name)
+        if name not in existing:
+            os.symlink(templates[i % len(templates)], os.path.join(camera_dir, name))
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic Xiaomi-style camera segments')
+    parser.add_argument('out_dir')
+    parser.add_argument('--segments', type=int, default=120)
+    parser.add_argument('--segment-seconds', type=int, default=60)
+    parser.add_argument('--templates', type=int, default=4)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--format', choices=FILENAME_FORMATS + ('both',), default='both')
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    args = parser.parse_args()
+
+    templates = generate_templates(args.out_dir, args.templates, args.segment_seconds, args.width, args.height,
+                                   args.ffmpeg)
+    formats = FILENAME_FORMATS if args.format == 'both' else (args.format,)
+    for filename_format in formats:
+        camera_dir = os.path.join(args.out_dir, f'XiaomiCamera_{filename_format}')
+        names = populate_camera(camera_dir, templates, args.segments, args.segment_seconds, filename_format)
+        print(f"{camera_dir}: {len(names)} segments")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+"""后端性能基准测试，离线运行
+
+生成合成录像 -> 启动本地 WebDAV 替身 -> 测量：
+  1. find_video_chunk：不同目录规模（两种文件名格式）下首次查找（含列目录）、重新列目录和命中索引的查找延迟
+  2. /api/video/stream：gunicorn（gevent worker）下的首字节时间、单流持续吞吐量和并发扩展性
+
+结果写成 JSON，指定 --baseline 时与之前的结果比较，退化超过 --tolerance 时以非零状态退出。
+
+    python -m benchmark.run --output bench.json
+    python -m benchmark.run --quick --baseline bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Sequence
+
+import requests
+
+from .footage import DEFAULT_START, FILENAME_FORMATS, generate_templates, populate_camera
+from .webdav_server import start_server
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentiles(values: Sequence[float], points: Sequence[int] = (50, 95, 99)) -> Dict[str, float]:
+    """最近秩百分位数"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {}
+    for point in points:
+        index = max(0, min(len(ordered) - 1, int(round(point / 100 * len(ordered) + 0.5)) - 1))
+        result[f'p{point}'] = round(ordered[index], 3)
+    result['mean'] = round(sum(ordered) / len(ordered), 3)
+    return result
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def app_environment(dav_url: str, work_dir: str, cameras: List[Dict], max_streams: int) -> Dict[str, str]:
+    """后端的环境变量：指向 WebDAV 替身，缓存和共享状态放在临时目录，关闭转码输出缓存避免重复播放命中
+
+    片段目录也放在本次运行的目录中，并清掉 --work-dir 重复使用时留下的旧文件，首次查找总是从 NAS 列目录。
+    """
+    config_path = os.path.join(work_dir, 'cfg.json')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump({'cameras': cameras}, f)
+    catalog_path = os.path.join(work_dir, 'catalog.db')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(catalog_path + suffix):
+            os.remove(catalog_path + suffix)
+    return {
+        'WEBDAV_SERVER': dav_url,
+        'CAMERA_CONFIG': config_path,
+        'FRAGMENT_CACHE_MAX_BYTES': '0',
+        'FRAGMENT_CACHE_DIR': os.path.join(work_dir, 'fragments'),
+        'BLOCK_CACHE_DIR': os.path.join(work_dir, 'blocks'),
+        'THUMBNAIL_CACHE_DIR': os.path.join(work_dir, 'thumbnails'),
+        'STREAM_REGISTRY_DB': os.path.join(work_dir, 'streams.db'),
+        'SEGMENT_CATALOG_DB': catalog_path,
+        'METRICS_DIR': os.path.join(work_dir, 'metrics'),
+        'TRANSCODE_MAX_GLOBAL': str(max_streams),
+        'TRANSCODE_MAX_PER_CAMERA': str(max_streams),
+        'TRANSCODE_MAX_PER_CLIENT': str(max_streams),
+        'TRANSCODE_QUEUE_WAIT': '60',
+        'EVENT_SCAN_INTERVAL': '0',
+    }
+
+
+def bench_find_video_chunk(dav_url: str, work_dir: str, footage_dir: str, templates: List[str],
+                           sizes: Sequence[int], segment_seconds: int, lookups: int, refreshes: int) -> List[Dict]:
+    """在本进程中调用 find_video_chunk，测量不同目录规模下的延迟"""
+    cameras = []
+    for filename_format in FILENAME_FORMATS:
+        for size in sizes:
+            name = f'find_{filename_format}_{size}'
+            populate_camera(os.path.join(footage_dir, name), templates, size, segment_seconds, filename_format)
+            cameras.append({'id': len(cameras) + 1, 'name': name, 'video_dir': f'/{name}', 'cam_model': '1'})
+
+    env = app_environment(dav_url, work_dir, cameras, 4)
+    # 本进程只测查找，不需要跨 worker 的共享状态
+    env.update({'STREAM_REGISTRY_DB': '', 'METRICS_DIR': '', 'BLOCK_CACHE_MAX_BYTES': '0'})
+    os.environ.update(env)
+    sys.path.insert(0, REPO_ROOT)
+    import logging
+    from backend import app as backend_app
+    from backend.segment_index import get_segment_index
+    from backend.webdav_client import get_client
+    # 每次查找都会写 INFO 日志，测量时关闭，只保留查找本身的开销
+    logging.getLogger().setLevel(logging.WARNING)
+    backend_app.logger.setLevel(logging.WARNING)
+
+    # 先建立到 WebDAV 的连接，首次查找的时间不包含建连
+    get_client()
+    results = []
+    rng = random.Random(1)
+    for camera in cameras:
+        size = int(camera['name'].rsplit('_', 1)[1])
+        filename_format = camera['name'].split('_')[1]
+        span = size * segment_seconds
+
+        def target(offset):
+            return (DEFAULT_START + timedelta(seconds=offset)).strftime('%Y-%m-%d %H:%M:%S')
+
+        started = time.perf_counter()
+        path, _ = backend_app.find_video_chunk(target(span // 2), camera['video_dir'])
+        cold_ms = (time.perf_counter() - started) * 1000
+        if not path:
+            raise RuntimeError(f"find_video_chunk found nothing in {camera['video_dir']}")
+
+        index = get_segment_index(camera['video_dir'])
+        refresh_ms = []
+        for _ in range(refreshes):
+            started = time.perf_counter()
+            index.refresh(get_client())
+            refresh_ms.append((time.perf_counter() - started) * 1000)
+
+        lookup_us = []
+        for _ in range(lookups):
+            offset = rng.randrange(span)
+            started = time.perf_counter()
+            backend_app.find_video_chunk(target(offset), camera['video_dir'])
+            lookup_us.append((time.perf_counter() - started) * 1e6)
+
+        result = {
+            'format': filename_format,
+            'segments': size,
+            'cold_ms': round(cold_ms, 3),
+            'refresh_ms': percentiles(refresh_ms),
+            'lookup_us': percentiles(lookup_us),
+        }
+        print(f"find_video_chunk {filename_format:8} {size:>6} segments: cold {cold_ms:8.1f} ms, "
+              f"refresh p50 {result['refresh_ms']['p50']:8.1f} ms, lookup p50 {result['lookup_us']['p50']:7.1f} us")
+        results.append(result)
+    return results
+
+
+class AppServer:
+    """以子进程方式运行的 gunicorn（gevent worker）"""
+
+    def __init__(self, env: Dict[str, str], workers: int, log_path: str):
+        self.port = free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        cmd = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{self.port}', '--worker-class', 'gevent',
+               '--workers', str(workers), '--worker-connections', '1000', '--timeout', '300', 'backend.app:app']
+        self._log = open(log_path, 'w')
+        self.process = subprocess.Popen(cmd, cwd=REPO_ROOT, env={**os.environ, **env},
+                                        stdout=self._log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float = 30) -> None:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {self.process.returncode}, see {self._log.name}")
+            try:
+                if requests.get(f'{self.base_url}/api/cameras', timeout=2).ok:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"gunicorn did not become ready, see {self._log.name}")
+
+    def stop(self) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self._log.close()
+
+
+def run_stream(base_url: str, video_dir: str, start_time: str, mode: str) -> Dict:
+    """请求一个流并读完，返回首字节时间、字节数和吞吐量"""
+    params = {'start_time': start_time, 'video_dir': video_dir, 'mode': mode,
+              'client_id': f'bench-{threading.get_ident()}'}
+    started = time.perf_counter()
+    try:
+        with requests.get(f'{base_url}/api/video/stream', params=params, stream=True, timeout=300) as response:
+            if response.status_code != 200:
+                return {'status': response.status_code}
+            first_byte = None
+            total = 0
+            for chunk in response.iter_content(64 * 1024):
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+                total += len(chunk)
+            finished = time.perf_counter()
+    except requests.RequestException as e:
+        return {'status': 'error', 'error': str(e)}
+    if first_byte is None or total == 0:
+        return {'status': 'empty'}
+    return {
+        'status': 200,
+        'ttfb_ms': (first_byte - started) * 1000,
+        'bytes': total,
+        'seconds': finished - started,
+        'mbps': total * 8 / 1e6 / max(finished - first_byte, 1e-6),
+    }
+
+
+def bench_streams(base_url: str, video_dir: str, segments: int, segment_seconds: int, modes: Sequence[str],
+                  concurrency_levels: Sequence[int], repeats: int) -> List[Dict]:
+    """各并发级别同时请求不同片段（不共享 FFmpeg），统计首字节时间和吞吐量"""
+    results = []
+    next_segment = [0]
+
+    def pick_start():
+        # 每个流用不同的片段，避免命中已在运行的广播或块缓存
+        i = next_segment[0] % segments
+        next_segment[0] += 1
+        return (DEFAULT_START + timedelta(seconds=i * segment_seconds + 1)).strftime('%Y-%m-%d %H:%M:%S')
+
+    for mode in modes:
+        for level in concurrency_levels:
+            runs = []
+            wall_started = time.perf_counter()
+            for _ in range(repeats):
+                starts = [pick_start() for _ in range(level)]
+                outputs = [None] * level
+                threads = [threading.Thread(target=lambda i=i: outputs.__setitem__(
+                    i, run_stream(base_url, video_dir, starts[i], mode))) for i in range(level)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                runs.extend(outputs)
+            wall = time.perf_counter() - wall_started
+            ok = [run for run in runs if run['status'] == 200]
+            total_bytes = sum(run['bytes'] for run in ok)
+            result = {
+                'mode': mode,
+                'concurrency': level,
+                'streams': len(runs),
+                'ok': len(ok),
+                'failed': len(runs) - len(ok),
+                'statuses': sorted({str(run['status']) for run in runs if run['status'] != 200}),
+                'ttfb_ms': percentiles([run['ttfb_ms'] for run in ok]),
+                'stream_mbps': percentiles([run['mbps'] for run in ok]),
+                'aggregate_mbps': round(total_bytes * 8 / 1e6 / wall, 3),
+            }
+            print(f"stream {mode:9} x{level:<3} ok {len(ok)}/{len(runs)}: ttfb p50 "
+                  f"{result['ttfb_ms'].get('p50', 0):7.0f} ms p95 {result['ttfb_ms'].get('p95', 0):7.0f} ms, "
+                  f"per-stream p50 {result['stream_mbps'].get('p50', 0):7.1f} Mbit/s, "
+                  f"aggregate {result['aggregate_mbps']:7.1f} Mbit/s")
+            results.append(result)
+    return results
+
+
+# 比较时关注的指标：(区块, 匹配字段, 指标路径, 越大越好)
+COMPARED_METRICS = (
+    ('find_video_chunk', ('format', 'segments'), ('cold_ms',), False),
+    ('find_video_chunk', ('format', 'segments'), ('refresh_ms', 'p50'), False),
+    ('find_video_chunk', ('format', 'segments'), ('lookup_us', 'p50'), False),
+    ('stream', ('mode', 'concurrency'), ('ttfb_ms', 'p50'), False),
+    ('stream', ('mode', 'concurrency'), ('ttfb_ms', 'p95'), False),
+    ('stream', ('mode', 'concurrency'), ('aggregate_mbps',), True),
+)
+
+
+def compare(baseline: Dict, current: Dict, tolerance: float) -> List[str]:
+    """与基准结果比较，返回退化超过容差的指标说明"""
+    regressions = []
+    for section, keys, path, higher_is_better in COMPARED_METRICS:
+        old_rows = {tuple(row[k] for k in keys): row for row in baseline.get(section, [])}
+        for row in current.get(section, []):
+            old = old_rows.get(tuple(row[k] for k in keys))
+            if old is None:
+                continue
+            old_value, new_value = old, row
+            for part in path:
+                old_value = old_value.get(part) if isinstance(old_value, dict) else None
+                new_value = new_value.get(part) if isinstance(new_value, dict) else None
+            if not old_value or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value
+            worse = -change if higher_is_better else change
+            label = f"{section} {'/'.join(str(row[k]) for k in keys)} {'.'.join(path)}"
+            print(f"  {label:55} {old_value:>12.3f} -> {new_value:>12.3f} ({change:+.1%})")
+            if worse > tolerance:
+                regressions.append(f"{label}: {old_value} -> {new_value} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline backend benchmark')
+    parser.add_argument('--output', default='benchmark-results.json', help='JSON results file')
+    parser.add_argument('--baseline', help='previous results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression (0.2 = 20%%)')
+    parser.add_argument('--work-dir', help='footage and cache directory, reused between runs (default: temp dir)')
+    parser.add_argument('--quick', action='store_true', help='smaller directories and fewer streams')
+    parser.add_argument('--sizes', default=None, help='directory sizes for find_video_chunk, e.g. 100,1000,10000')
+    parser.add_argument('--segment-seconds', type=int, default=60)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--modes', default='copy,transcode', help='stream modes to measure')
+    parser.add_argument('--concurrency', default=None, help='concurrency levels, e.g. 1,2,4,8')
+    parser.add_argument('--repeats', type=int, default=None, help='rounds per concurrency level')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers')
+    parser.add_argument('--rate', type=int, default=0, help='WebDAV per-connection bytes/s limit, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0.0, help='WebDAV added latency per request (ms)')
+    parser.add_argument('--skip-find', action='store_true')
+    parser.add_argument('--skip-stream', action='store_true')
+    parser.add_argument('--ffmpeg', default='ffmpeg')
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in (args.sizes or ('100,1000' if args.quick else '100,1000,10000')).split(',')]
+    levels = [int(x) for x in (args.concurrency or ('1,2' if args.quick else '1,2,4,8')).split(',')]
+    repeats = args.repeats or (1 if args.quick else 2)
+    modes = [mode for mode in args.modes.split(',') if mode]
+    if shutil.which(args.ffmpeg) is None:
+        parser.error(f"{args.ffmpeg} not found")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='xiaomi_cctv_bench_')
+    footage_dir = os.path.join(work_dir, 'footage')
+    os.makedirs(footage_dir, exist_ok=True)
+    print(f"Work directory: {work_dir}")
+
+    templates = generate_templates(footage_dir, 4, args.segment_seconds, args.width, args.height, args.ffmpeg)
+    dav = start_server(footage_dir, rate=args.rate, latency=args.latency / 1000)
+    dav_url = f'http://127.0.0.1:{dav.server_address[1]}'
+
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'segment_seconds': args.segment_seconds,
+            'resolution': f'{args.width}x{args.height}',
+            'webdav_rate': args.rate,
+            'webdav_latency_ms': args.latency,
+            'workers': args.workers,
+        },
+        'find_video_chunk': [],
+        'stream': [],
+    }
+
+    if not args.skip_stream:
+        stream_segments = max(levels) * repeats * len(modes) + 1
+        populate_camera(os.path.join(footage_dir, 'stream'), templates, stream_segments, args.segment_seconds)
+        cameras = [{'id': 1, 'name': 'stream', 'video_dir': '/stream', 'cam_model': '1'}]
+        app_dir = os.path.join(work_dir, 'app')
+        os.makedirs(app_dir, exist_ok=True)
+        server = AppServer(app_environment(dav_url, app_dir, cameras, max(levels)), args.workers,
+                           os.path.join(work_dir, 'gunicorn.log'))
+        try:
+            server.wait_ready()
+            results['stream'] = bench_streams(server.base_url, '/stream', stream_segments, args.segment_seconds,
+                                              modes, levels, repeats)
+        finally:
+            server.stop()
+
+    if not args.skip_find:
+        # 放在最后：会在本进程中导入后端并修改环境变量
+        find_dir = os.path.join(work_dir, 'find')
+        os.makedirs(find_dir, exist_ok=True)
+        results['find_video_chunk'] = bench_find_video_chunk(
+            dav_url, find_dir, footage_dir, templates, sizes, args.segment_seconds,
+            lookups=200 if args.quick else 1000, refreshes=3 if args.quick else 5)
+
+    dav.shutdown()
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.baseline} (revision {baseline.get('meta', {}).get('revision')}):")
+        regressions = compare(baseline, results, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions beyond {args.tolerance:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
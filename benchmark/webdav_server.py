@@ -0,0 +1,184 @@
+"""本地 WebDAV 替身：把磁盘目录按 WebDAV 协议提供给后端
+
+只实现后端用到的部分：PROPFIND（Depth 0/1，返回 resourcetype/getcontentlength/getlastmodified）、
+GET/HEAD（支持 Range）。可以限制每个连接的传输速率、给每个请求加固定延迟，模拟家用 NAS。
+
+    python -m benchmark.webdav_server /tmp/footage --port 18080 --rate 2000000 --latency 20
+"""
+import argparse
+import http.server
+import os
+import re
+import threading
+import time
+from email.utils import formatdate
+from typing import Optional
+from urllib.parse import quote, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+CHUNK_SIZE = 64 * 1024
+
+
+class WebDAVRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 响应头和响应体分两次写出，不关闭 Nagle 时小响应会多出约 40ms 的延迟确认等待
+    disable_nagle_algorithm = True
+    # 由 make_server 设置
+    root = '.'
+    rate = 0
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _local_path(self) -> Optional[str]:
+        path = unquote(urlsplit(self.path).path)
+        full = os.path.realpath(os.path.join(self.root, path.lstrip('/')))
+        root = os.path.realpath(self.root)
+        if full != root and not full.startswith(root + os.sep):
+            return None
+        return full
+
+    def _delay(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _send_empty(self, code: int) -> None:
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    @staticmethod
+    def _response_xml(href: str, full: str) -> str:
+        stat = os.stat(full)
+        if os.path.isdir(full):
+            props = '<D:resourcetype><D:collection/></D:resourcetype>'
+        else:
+            props = f'<D:resourcetype/><D:getcontentlength>{stat.st_size}</D:getcontentlength>'
+        props += f'<D:getlastmodified>{formatdate(stat.st_mtime, usegmt=True)}</D:getlastmodified>'
+        return (f'<D:response><D:href>{escape(quote(href))}</D:href><D:propstat><D:prop>{props}</D:prop>'
+                f'<D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>')
+
+    def do_PROPFIND(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self._delay()
+        full = self._local_path()
+        if full is None or not os.path.exists(full):
+            self._send_empty(404)
+            return
+        href = unquote(urlsplit(self.path).path)
+        parts = [self._response_xml(href, full)]
+        if os.path.isdir(full) and self.headers.get('Depth', '1') != '0':
+            base = href.rstrip('/') + '/'
+            with os.scandir(full) as entries:
+                for entry in sorted(entries, key=lambda e: e.name):
+                    parts.append(self._response_xml(base + entry.name, entry.path))
+        body = ('<?xml version="1.0" encoding="utf-8"?><D:multistatus xmlns:D="DAV:">'
+                + ''.join(parts) + '</D:multistatus>').encode()
+        self.send_response(207)
+        self.send_header('Content-Type', 'application/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._serve_file(send_body=False)
+
+    def do_GET(self):
+        self._serve_file(send_body=True)
+
+    def _serve_file(self, send_body: bool) -> None:
+        self._delay()
+        full = self._local_path()
+        if full is None or not os.path.isfile(full):
+            self._send_empty(404)
+            return
+        size = os.path.getsize(full)
+        start, end, code = 0, size - 1, 200
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            code = 206
+        self.send_response(code)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if code == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if not send_body:
+            return
+        remaining = end - start + 1
+        started = time.monotonic()
+        sent = 0
+        try:
+            with open(full, 'rb') as f:
+                f.seek(start)
+                while remaining > 0:
+                    data = f.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+                    sent += len(data)
+                    if self.rate:
+                        # 按已发送字节数限速，保持平均速率
+                        ahead = sent / self.rate - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def make_server(root: str, host: str = '127.0.0.1', port: int = 0, rate: int = 0,
+                latency: float = 0.0) -> http.server.ThreadingHTTPServer:
+    """创建 WebDAV 替身服务器（未启动）
+
+    Args:
+        root: 提供的目录
+        port: 监听端口，0 表示随机端口
+        rate: 每个连接的传输速率上限（字节/秒），0 表示不限
+        latency: 每个请求的固定延迟（秒）
+    """
+    handler = type('BoundWebDAVRequestHandler', (WebDAVRequestHandler,),
+                   {'root': root, 'rate': rate, 'latency': latency})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_server(root: str, **kwargs) -> http.server.ThreadingHTTPServer:
+    """在后台线程中启动服务器，返回服务器对象（server_address 为实际地址）"""
+    server = make_server(root, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local WebDAV stand-in for benchmarks')
+    parser.add_argument('root', help='directory to serve')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--rate', type=int, default=0, help='per-connection bytes/s limit, 0 for unlimited')
+    parser.add_argument('--latency', type=float, default=0.0, help='added latency per request in milliseconds')
+    args = parser.parse_args()
+    server = make_server(args.root, args.host, args.port, args.rate, args.latency / 1000)
+    print(f"Serving {args.root} at http://{args.host}:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
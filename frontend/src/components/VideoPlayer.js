@@ -54,6 +54,12 @@ const VideoPlayer = () => {
 
   // 存储事件监听器引用
   const eventListenersRef = useRef({});
+  // 每个播放器实例的客户端 ID，停止时只停止自己的流
+  const clientIdRef = useRef(
+    (window.crypto && window.crypto.randomUUID)
+      ? window.crypto.randomUUID()
+      : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`
+  );
 
   // 停止视频流
   const stopVideoStream = useCallback(() => {
@@ -65,7 +71,7 @@ const VideoPlayer = () => {
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({})
+        body: JSON.stringify({ client_id: clientIdRef.current })
       }).then(response => {
         if (response.ok) {
           console.log('Video stream stopped successfully');
@@ -80,12 +86,14 @@ const VideoPlayer = () => {
     }
   }, []);
 
-  // 清理函数
-  const cleanup = useCallback(() => {
+  // 清理函数；换一个时间点重新加载时不需要单独停止后端流，新请求会取代同一客户端在该摄像头上的旧流
+  const cleanup = useCallback(({ stopBackend = true } = {}) => {
     console.log('Cleaning up resources...');
     
     // 停止后端流
-    stopVideoStream();
+    if (stopBackend) {
+      stopVideoStream();
+    }
     
     if (abortControllerRef.current) {
       console.log('Aborting previous request...');
@@ -191,7 +199,8 @@ const VideoPlayer = () => {
   const loadVideo = useCallback(async (url) => {
     if (requestInProgressRef.current) {
       console.log('Request already in progress, aborting previous request');
-      cleanup();
+      // 按 client_id 停止会和紧接着的新请求竞争，旧流由后端在新请求到达时停止
+      cleanup({ stopBackend: false });
     }
 
     console.log('Starting video load:', url);
@@ -334,7 +343,7 @@ const VideoPlayer = () => {
         console.log('Current time object:', currentTime);
         console.log('Formatted start time:', startTime);
         
-        const url = `${config.API_BASE_URL}/api/video/stream?start_time=${encodeURIComponent(startTime)}&video_dir=${encodeURIComponent(camera.video_dir)}&playback_rate=${playbackRate}`;
+        const url = `${config.API_BASE_URL}/api/video/stream?start_time=${encodeURIComponent(startTime)}&video_dir=${encodeURIComponent(camera.video_dir)}&playback_rate=${playbackRate}&continuous=1&client_id=${encodeURIComponent(clientIdRef.current)}`;
         console.log('Generated URL:', url);
         
         loadVideo(url);
@@ -357,7 +366,7 @@ const VideoPlayer = () => {
     console.log('loadNewVideo - Current time object:', currentTime);
     console.log('loadNewVideo - Formatted start time:', startTime);
     
-    const url = `${config.API_BASE_URL}/api/video/stream?start_time=${encodeURIComponent(startTime)}&video_dir=${encodeURIComponent(camera.video_dir)}&playback_rate=${playbackRate}`;
+    const url = `${config.API_BASE_URL}/api/video/stream?start_time=${encodeURIComponent(startTime)}&video_dir=${encodeURIComponent(camera.video_dir)}&playback_rate=${playbackRate}&continuous=1&client_id=${encodeURIComponent(clientIdRef.current)}`;
     console.log('loadNewVideo - Generated URL:', url);
     
     loadVideo(url);
@@ -400,11 +409,9 @@ const VideoPlayer = () => {
   }, []);
 
   // 处理播放速度变化
+  // 速率由服务端转码时处理（重新计算时间戳并丢帧），播放器本身始终按 1x 播放
   const handlePlaybackRateChange = useCallback((rate) => {
     setPlaybackRate(rate);
-    if (videoRef.current) {
-      videoRef.current.playbackRate = rate;
-    }
   }, []);
 
   // 处理日期导航
@@ -448,14 +455,14 @@ const VideoPlayer = () => {
     setIsDragging(false);
     setIsPlaying(false);
     
-    // 清理当前视频
-    cleanup();
+    // 清理当前视频，旧的后端流由新请求取代
+    cleanup({ stopBackend: false });
     
     // 加载新视频
     const startTime = newTime.format('YYYY-MM-DD HH:mm:ss');
     console.log('Timeline change committed - New time:', startTime);
     
-    const url = `${config.API_BASE_URL}/api/video/stream?start_time=${encodeURIComponent(startTime)}&video_dir=${encodeURIComponent(camera.video_dir)}&playback_rate=${playbackRate}`;
+    const url = `${config.API_BASE_URL}/api/video/stream?start_time=${encodeURIComponent(startTime)}&video_dir=${encodeURIComponent(camera.video_dir)}&playback_rate=${playbackRate}&continuous=1&client_id=${encodeURIComponent(clientIdRef.current)}`;
     console.log('Timeline change committed - Generated URL:', url);
     
     loadVideo(url);
@@ -541,6 +548,8 @@ const VideoPlayer = () => {
             <MenuItem value={1}>1x</MenuItem>
             <MenuItem value={2}>2x</MenuItem>
             <MenuItem value={4}>4x</MenuItem>
+            <MenuItem value={16}>16x</MenuItem>
+            <MenuItem value={64}>64x</MenuItem>
           </Select>
         </FormControl>
       </Box>